@@ -0,0 +1,102 @@
+"""
+Benchmark of buy_building and prestige_up under contention
+
+Usage:
+    python -m benchmarks.buy_contention [users] [taps_per_user]
+
+Creates temporary users (negative telegram ids) in the configured database,
+fires all purchase taps concurrently, reports latency percentiles and checks that nobody overspent.
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+
+from database import ConnectionManager
+from users.user_repo import UserDAO
+
+BENCH_ID_OFFSET = -1_000_000_000
+
+
+def percentiles(samples: list[float]) -> str:
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100)
+    return (
+        f"p50 {quantiles[49] * 1000:.1f}ms, p95 {quantiles[94] * 1000:.1f}ms, "
+        f"p99 {quantiles[98] * 1000:.1f}ms, max {samples[-1] * 1000:.1f}ms"
+    )
+
+
+async def timed(coro) -> tuple[float, object]:
+    start = time.perf_counter()
+    res = await coro
+    return time.perf_counter() - start, res
+
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    taps = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    dao = UserDAO()
+    telegram_ids = [BENCH_ID_OFFSET - i for i in range(users)]
+    async with ConnectionManager() as conn:
+        building_id, cost = await conn.fetchrow(
+            "SELECT id, cost FROM buildings ORDER BY cost LIMIT 1"
+        )
+        await conn.execute(
+            "DELETE FROM users WHERE telegram_id = ANY($1::bigint[])", telegram_ids
+        )
+        # Every user can afford exactly half of the taps
+        await conn.execute(
+            "INSERT INTO users (telegram_id, currency) SELECT unnest($1::bigint[]), $2",
+            telegram_ids,
+            cost * (taps // 2),
+        )
+    try:
+        results = await asyncio.gather(
+            *(
+                timed(dao.buy_building(telegram_id, building_id))
+                for telegram_id in telegram_ids
+                for _ in range(taps)
+            )
+        )
+        latencies = [latency for latency, _ in results]
+        bought = sum(1 for _, res in results if res)
+        print(f"buy_building, {users} users x {taps} concurrent taps")
+        print(f"  {percentiles(latencies)}")
+        print(f"  successful purchases: {bought} (expected {users * (taps // 2)})")
+
+        async with ConnectionManager() as conn:
+            overspent = await conn.fetchval(
+                "SELECT count(*) FROM users WHERE telegram_id = ANY($1::bigint[]) AND currency < 0",
+                telegram_ids,
+            )
+            await conn.execute(
+                "UPDATE users SET currency = $2 WHERE telegram_id = ANY($1::bigint[])",
+                telegram_ids,
+                10**12,
+            )
+        print(f"  users with negative balance: {overspent}")
+
+        results = await asyncio.gather(
+            *(
+                timed(dao.prestige_up(telegram_id, 1))
+                for telegram_id in telegram_ids
+                for _ in range(taps)
+            )
+        )
+        latencies = [latency for latency, _ in results]
+        prestiged = sum(1 for _, res in results if res)
+        print(f"prestige_up, {users} users x {taps} concurrent taps")
+        print(f"  {percentiles(latencies)}")
+        print(f"  successful prestiges: {prestiged} (expected {users})")
+    finally:
+        async with ConnectionManager() as conn:
+            await conn.execute(
+                "DELETE FROM users WHERE telegram_id = ANY($1::bigint[])", telegram_ids
+            )
+        await ConnectionManager.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,298 @@
+"""
+End-to-end load test of the bot handlers
+
+Usage:
+    python -m benchmarks.load_test [players] [rounds] [--save]
+
+Drives the real Dispatcher and Game handlers with synthetic updates from simulated players
+(negative telegram ids) against the configured database, answering Bot API calls with a fake session.
+Every scenario step is sent by all players concurrently, rounds times per player, and reports
+throughput, latency percentiles, SQL statements, pool acquires and opened connections per update.
+
+--save stores the results as the baseline (benchmarks/load_test_baseline.json) together with
+the machine and the run parameters; later runs are compared against it, so regressions in DAOs
+or middleware show up as numbers. Without a baseline the comparison is skipped.
+Baselines are machine specific and are not committed, save one on the machine running the comparison.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message, Update, User
+
+import metrics
+from benchmarks.buy_contention import BENCH_ID_OFFSET
+from catalog import catalog
+from database import ConnectionManager
+from main import Game
+from settings import Settings
+
+BASELINE = os.path.join(os.path.dirname(__file__), "load_test_baseline.json")
+# Slowdown relative to the baseline reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+update_ids = itertools.count(1)
+
+
+class FakeSession(BaseSession):
+    """
+    Bot API session answering every call locally
+    """
+
+    async def make_request(
+        self, bot: Bot, method: TelegramMethod, timeout: int | None = None
+    ) -> Any:
+        if method.__returning__ is Message:
+            chat_id = getattr(method, "chat_id", 0) or 0
+            return Message(
+                message_id=1,
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"),
+                text=getattr(method, "text", None),
+            )
+        if method.__returning__ is User:
+            return User(id=42, is_bot=True, first_name="bench")
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+def message_update(telegram_id: int, text: str) -> dict:
+    update_id = next(update_ids)
+    user = {"id": telegram_id, "is_bot": False, "first_name": "bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": telegram_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+def callback_update(telegram_id: int, data: str) -> dict:
+    update_id = next(update_ids)
+    user = {"id": telegram_id, "is_bot": False, "first_name": "bench"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": telegram_id, "type": "private"},
+                "text": "bench",
+            },
+        },
+    }
+
+
+def percentile(samples: list[float], q: int) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, len(samples) * q // 100)]
+
+
+def counted() -> tuple[int, int, int]:
+    """
+    Total SQL statements, pool acquires and opened connections so far.\n
+    Named statements are recorded by StatementConnection.run_statement, other queries by the query logger.
+    """
+    queries = sum(sum(counts) for counts, _ in metrics.query_seconds.series.values())
+    acquires = sum(
+        sum(counts) for counts, _ in metrics.pool_wait_seconds.series.values()
+    )
+    return queries, acquires, int(sum(metrics.connections_opened.values.values()))
+
+
+async def run_step(
+    dp: Dispatcher, bot: Bot, players: list[int], rounds: int, make_update
+) -> dict[str, float]:
+    latencies: list[float] = []
+
+    async def play(telegram_id: int):
+        for _ in range(rounds):
+            update = make_update(telegram_id)
+            start = time.perf_counter()
+            await dp.feed_update(
+                bot, Update.model_validate(update, context={"bot": bot})
+            )
+            latencies.append(time.perf_counter() - start)
+
+    before = counted()
+    start = time.perf_counter()
+    await asyncio.gather(*(play(telegram_id) for telegram_id in players))
+    elapsed = time.perf_counter() - start
+    # Query loggers are called soon after the statements
+    await asyncio.sleep(0.1)
+    queries, acquires, connections = (
+        after - was for after, was in zip(counted(), before)
+    )
+    updates = len(latencies)
+    return {
+        "updates_per_second": updates / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "queries_per_update": queries / updates,
+        "acquires_per_update": acquires / updates,
+        "connections_per_update": connections / updates,
+    }
+
+
+def environment(players: int, rounds: int) -> dict[str, object]:
+    """
+    Machine and parameters of the run, stored with the baseline
+    """
+    return {
+        "machine": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "players": players,
+        "rounds": rounds,
+    }
+
+
+def save(baseline: dict) -> None:
+    with open(BASELINE, "w") as file:
+        json.dump(baseline, file, indent=2)
+    print(f"Baseline saved to {BASELINE}")
+
+
+def compare(results: dict[str, dict[str, float]], run: dict[str, object]) -> None:
+    if not os.path.exists(BASELINE):
+        print(
+            f"Regression check skipped: no baseline at {BASELINE}, run with --save to create one"
+        )
+        return
+    with open(BASELINE) as file:
+        saved = json.load(file)
+    baseline = saved["results"]
+    for name, value in saved["environment"].items():
+        if run.get(name) != value:
+            print(f"WARNING baseline {name} differs: {value} -> {run.get(name)}")
+    regressions = 0
+    for step, values in results.items():
+        for name, value in values.items():
+            was = baseline.get(step, {}).get(name)
+            if not was:
+                continue
+            ratio = value / was
+            worse = (
+                ratio < 1 / REGRESSION_THRESHOLD
+                if name == "updates_per_second"
+                else ratio > REGRESSION_THRESHOLD
+            )
+            if worse:
+                regressions += 1
+                print(f"REGRESSION {step} {name}: {was:.2f} -> {value:.2f}")
+    print(f"{regressions} regressions compared to the baseline")
+
+
+async def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    players_count = int(args[0]) if len(args) > 0 else 100
+    rounds = int(args[1]) if len(args) > 1 else 5
+    # Only the handlers are measured: no rate limits, no background duties
+    Settings.outbox_global_rate = Settings.outbox_chat_rate = 10**9
+    Settings.outbox_chat_burst = 10**9
+    Settings.user_task_scheduler = "postgres"
+
+    players = [BENCH_ID_OFFSET - i for i in range(players_count)]
+    bot = Bot("42:BENCHMARK", session=FakeSession())
+    dp = Dispatcher()
+    Game(dp, bot, leader=False)
+    buildings = await catalog.get_buildings(1)
+    tasks = await catalog.get_tasks(1)
+    cheapest = min(buildings, key=lambda building: building.cost)
+
+    async def cleanup():
+        async with ConnectionManager() as conn:
+            await conn.execute(
+                """DELETE FROM user_user_tasks WHERE user_id IN
+                    (SELECT id FROM users WHERE telegram_id = ANY($1::bigint[]))""",
+                players,
+            )
+            await conn.execute(
+                """DELETE FROM users_buildings WHERE user_id IN
+                    (SELECT id FROM users WHERE telegram_id = ANY($1::bigint[]))""",
+                players,
+            )
+            await conn.execute(
+                "DELETE FROM users WHERE telegram_id = ANY($1::bigint[])", players
+            )
+
+    async def fund():
+        async with ConnectionManager() as conn:
+            await conn.execute(
+                "UPDATE users SET currency = $2 WHERE telegram_id = ANY($1::bigint[])",
+                players,
+                10**15,
+            )
+
+    steps = [
+        ("start", 1, lambda tid: message_update(tid, "/start"), None),
+        ("status", rounds, lambda tid: message_update(tid, "Статус"), fund),
+        (
+            "buildings_list",
+            rounds,
+            lambda tid: message_update(tid, "Список зданий"),
+            None,
+        ),
+        ("buy", rounds, lambda tid: callback_update(tid, f"buy_{cheapest.id}"), None),
+        ("task", rounds, lambda tid: callback_update(tid, f"task_{tasks[0].id}"), None),
+        ("prestige", rounds, lambda tid: callback_update(tid, "prestige"), None),
+    ]
+    results: dict[str, dict[str, float]] = {}
+    await cleanup()
+    try:
+        for name, step_rounds, make_update, after in steps:
+            results[name] = await run_step(dp, bot, players, step_rounds, make_update)
+            if after:
+                await after()
+    finally:
+        await cleanup()
+        await ConnectionManager.close_pool()
+
+    print(f"{players_count} players, {rounds} rounds")
+    for name, values in results.items():
+        print(
+            f"  {name:<15} {values['updates_per_second']:8.0f} upd/s  "
+            f"p50 {values['p50_ms']:6.1f}ms  p95 {values['p95_ms']:6.1f}ms  p99 {values['p99_ms']:6.1f}ms  "
+            f"queries {values['queries_per_update']:.2f}  acquires {values['acquires_per_update']:.2f}  "
+            f"connections {values['connections_per_update']:.3f}"
+        )
+    # Every step runs SQL, zero means statements are not recorded in the metrics
+    unrecorded = [
+        name for name, values in results.items() if not values["queries_per_update"]
+    ]
+    if unrecorded:
+        print(f"WARNING no SQL statements recorded for: {', '.join(unrecorded)}")
+    run = environment(players_count, rounds)
+    if "--save" in sys.argv:
+        save({"environment": run, "results": results})
+    else:
+        compare(results, run)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,360 @@
+"""
+Query plan regression check of the named SQL statements on a large seeded world
+
+Usage:
+    python -m benchmarks.query_plans [users] [buildings_per_user] [--seed] [--save]
+
+Works on a separate database (the configured name with a "_plans" suffix), created and migrated if needed.
+The world is seeded when the database holds a different number of users or with --seed:
+users with random stats, about buildings_per_user buildings each and a share of them running a task.
+
+Every statement of statements.py is run with EXPLAIN (ANALYZE, BUFFERS) inside a rolled back transaction,
+and fails the check if it scans a large table sequentially (unless it is a full scan by design)
+or exceeds its cost or time budget. Missing indexes are proposed from the filters of such scans
+and from foreign keys without an index. Exits with 1 if any statement failed.
+
+--save stores the plans as the baseline (benchmarks/query_plans_baseline.json); later runs
+report statements whose plans changed since.
+"""
+
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+import asyncpg
+
+from database import ConnectionManager
+from settings import Settings
+from statements import STATEMENTS
+from tables import MigrationManager
+
+BASELINE = os.path.join(os.path.dirname(__file__), "query_plans_baseline.json")
+# Share of users running a task
+BUSY_SHARE = 0.2
+# Tables with at least this many rows must not be scanned sequentially
+LARGE_TABLE_ROWS = 10_000
+# Scans removing at least this many rows by their filter get an index proposed
+REMOVED_ROWS = 1_000
+# Best execution time of this many runs is compared to the budget
+REPEATS = 3
+# Default budget of a statement: total plan cost and execution time in milliseconds
+COST_BUDGET = 1_000
+TIME_BUDGET_MS = 10
+# Statements touching a chunk of rows have larger budgets
+BUDGETS: dict[str, tuple[float, float]] = {
+    "users.currency_tick": (100_000, 500),
+    "tasks.complete_due": (20_000, 100),
+    "leaderboard.scores": (20_000, 100),
+}
+# Statements reading every user by design, run by maintenance commands only
+FULL_SCANS = {"users.find_income_drift", "users.repair_income_drift"}
+
+
+def parameters(sample: dict) -> dict[str, tuple]:
+    """
+    Arguments of every statement, like the DAOs pass them, for the sampled players
+    """
+    busy, idle = sample["busy"], sample["idle"]
+    tick = Settings.currency_tick_interval
+    return {
+        "users.update_currency": (100, idle),
+        "users.get_level": (idle,),
+        "users.prestige_up": (idle, tick, sample["prestige"], 0),
+        "users.register": (-1,),
+        "users.check": (idle,),
+        "users.buy_building": (idle, sample["building_id"], tick),
+        "users.get_last_currency_tick": (),
+        "users.set_last_currency_tick": (sample["now"],),
+        "users.set_accrual_interval": (tick,),
+        "users.get_max_id": (),
+        "users.currency_tick": (
+            sample["max_id"] // 2,
+            sample["max_id"] // 2 + Settings.currency_tick_chunk_size,
+            sample["now"],
+            1,
+            tick,
+        ),
+        "users.get_currency": (idle, tick),
+        "users.get_income": (idle,),
+        "users.find_income_drift": (),
+        "users.repair_income_drift": (tick,),
+        "users.get_player_snapshot": (busy, tick),
+        "users.get_prestige": (idle,),
+        "users.add_xp": (idle, 100),
+        "users.apply_levels": ([idle], [2], [0], [100]),
+        "tasks.complete": ([busy], [sample["task_id"]]),
+        "tasks.get_active": (busy,),
+        "tasks.start": (idle, sample["task_id"], tick, tick),
+        "tasks.complete_due": (Settings.task_sweep_batch,),
+        "catalog.buildings": (),
+        "catalog.tasks": (),
+        "leaderboard.scores": (
+            sample["max_id"] // 2,
+            Settings.leaderboard_chunk_size,
+            tick,
+        ),
+        "migrations.applied": (),
+        "migrations.record": ("query_plans.sql", "0" * 64),
+        "migrations.set_checksum": ("0001.sql", "0" * 64),
+    }
+
+
+async def seed(conn, users: int, buildings_per_user: int) -> None:
+    start = time.perf_counter()
+    buildings = await conn.fetchval("SELECT count(*) FROM buildings")
+    await conn.execute(
+        "TRUNCATE users, users_buildings, user_user_tasks RESTART IDENTITY CASCADE"
+    )
+    # Registration notifications are useless here and slow down the insert
+    await conn.execute("ALTER TABLE users DISABLE TRIGGER users_changed")
+    try:
+        await conn.execute(
+            """INSERT INTO users (telegram_id, currency, prestige, lvl, xp, last_accrued_at)
+            SELECT g, (random() * 1e12)::BIGINT, 1 + (random() * random() * 5)::INTEGER,
+                1 + (random() * 50)::BIGINT, (random() * 1e5)::BIGINT,
+                now() - random() * interval '1 day'
+            FROM generate_series(1, $1) g""",
+            users,
+        )
+    finally:
+        await conn.execute("ALTER TABLE users ENABLE TRIGGER users_changed")
+    await conn.execute(
+        """INSERT INTO users_buildings (user_id, building_id, count)
+        SELECT u.id, b.id, 1 + (random() * 100)::BIGINT
+        FROM users u CROSS JOIN buildings b
+        WHERE random() < $1""",
+        min(1.0, buildings_per_user / max(buildings, 1)),
+    )
+    await conn.execute(
+        """UPDATE users u SET income = owned.income * u.prestige
+        FROM (
+            SELECT ub.user_id, SUM(ub.count * b.income) AS income
+            FROM users_buildings ub JOIN buildings b ON b.id = ub.building_id
+            GROUP BY ub.user_id
+        ) owned
+        WHERE u.id = owned.user_id"""
+    )
+    # Tasks end within an hour before or after now, so some are due
+    await conn.execute(
+        """INSERT INTO user_user_tasks (user_id, task_id, started_at, ends_at)
+        SELECT id, (SELECT min(id) FROM user_tasks), now() - interval '1 hour',
+            now() + (random() - 0.5) * interval '2 hours'
+        FROM users WHERE random() < $1""",
+        BUSY_SHARE,
+    )
+    await conn.execute("VACUUM ANALYZE")
+    print(f"Seeded {users} users in {time.perf_counter() - start:.1f}s")
+
+
+async def get_sample(conn) -> dict:
+    """
+    Picks players from the middle of the table, one running a task and one without
+    """
+    middle = await conn.fetchval("SELECT max(id) / 2 FROM users")
+    busy = await conn.fetchrow(
+        """SELECT u.telegram_id, t.task_id FROM users u
+        JOIN user_user_tasks t ON t.user_id = u.id
+        WHERE u.id >= $1 ORDER BY u.id LIMIT 1""",
+        middle,
+    )
+    idle = await conn.fetchrow(
+        """SELECT telegram_id, prestige FROM users u
+        WHERE id >= $1 AND NOT EXISTS (SELECT 1 FROM user_user_tasks WHERE user_id = u.id)
+        ORDER BY id LIMIT 1""",
+        middle,
+    )
+    return {
+        "busy": busy["telegram_id"],
+        "task_id": busy["task_id"],
+        "idle": idle["telegram_id"],
+        "prestige": idle["prestige"],
+        "building_id": await conn.fetchval(
+            "SELECT id FROM buildings ORDER BY cost LIMIT 1"
+        ),
+        "max_id": middle * 2,
+        "now": datetime.now(timezone.utc),
+    }
+
+
+def walk(node: dict):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from walk(child)
+
+
+def shape(plan: dict) -> list[str]:
+    """
+    Scans and joins of the plan, compared with the baseline
+    """
+    return [
+        " ".join(
+            filter(
+                None,
+                (node["Node Type"], node.get("Relation Name"), node.get("Index Name")),
+            )
+        )
+        for node in walk(plan)
+        if "Scan" in node["Node Type"]
+        or "Join" in node["Node Type"]
+        or "Nested Loop" in node["Node Type"]
+    ]
+
+
+async def explain(conn, query: str, args: tuple) -> dict:
+    """
+    Runs the statement with EXPLAIN ANALYZE REPEATS times and rolls it back
+    :returns: the last plan with the best execution time
+    """
+    times = []
+    for _ in range(REPEATS):
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            result = await conn.fetchval(
+                f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", *args
+            )
+        finally:
+            await transaction.rollback()
+        plan = json.loads(result)[0]
+        times.append(plan["Execution Time"])
+    plan["Execution Time"] = min(times)
+    return plan
+
+
+def filtered_columns(node: dict, columns: set[str]) -> list[str]:
+    names = re.findall(r"\b([a-z_][a-z0-9_]*)\b", node.get("Filter", ""))
+    return list(dict.fromkeys(name for name in names if name in columns))
+
+
+def compare_plans(plans: dict[str, list[str]]) -> None:
+    """
+    Saves the plans as the baseline with --save, otherwise reports plans changed since the baseline
+    """
+    if "--save" in sys.argv:
+        with open(BASELINE, "w") as file:
+            json.dump(plans, file, indent=2)
+        print(f"Baseline saved to {BASELINE}")
+    elif os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+        for name, nodes in plans.items():
+            if name in baseline and baseline[name] != nodes:
+                print(f"PLAN CHANGED {name}: {baseline[name]} -> {nodes}")
+
+
+async def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    users = int(args[0]) if len(args) > 0 else 1_000_000
+    buildings_per_user = int(args[1]) if len(args) > 1 else 5
+    Settings.database_name = f"{Settings.database_name}_plans"
+    await MigrationManager().migrate()
+
+    async with ConnectionManager() as conn:
+        if (
+            "--seed" in sys.argv
+            or await conn.fetchval("SELECT count(*) FROM users") != users
+        ):
+            await seed(conn, users, buildings_per_user)
+        sample = await get_sample(conn)
+        rows = {
+            row["relname"]: row["reltuples"]
+            for row in await conn.fetch(
+                "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'"
+            )
+        }
+        large = {table for table, count in rows.items() if count >= LARGE_TABLE_ROWS}
+        columns: dict[str, set[str]] = {}
+        for row in await conn.fetch(
+            """SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = 'public'"""
+        ):
+            columns.setdefault(row["table_name"], set()).add(row["column_name"])
+        # Leading columns of the existing indexes
+        indexed = {
+            (row["table"], row["column"])
+            for row in await conn.fetch(
+                """SELECT t.relname AS table, a.attname AS column
+                FROM pg_index i
+                JOIN pg_class t ON t.oid = i.indrelid
+                JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[0]"""
+            )
+        }
+        foreign_keys = await conn.fetch(
+            """SELECT c.conrelid::regclass::text AS table, a.attname AS column
+            FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+            WHERE c.contype = 'f'"""
+        )
+
+        arguments = parameters(sample)
+        plans: dict[str, list[str]] = {}
+        failures: list[str] = []
+        proposals: dict[tuple[str, ...], set[str]] = {}
+        print(f"{sample['max_id']} users, {len(STATEMENTS)} statements")
+        for name, query in STATEMENTS.items():
+            if name not in arguments:
+                failures.append(f"{name}: no sample parameters")
+                continue
+            try:
+                result = await explain(conn, query, arguments[name])
+            except asyncpg.PostgresError as e:
+                failures.append(f"{name}: {e}")
+                continue
+            plan = result["Plan"]
+            cost, elapsed = plan["Total Cost"], result["Execution Time"]
+            plans[name] = shape(plan)
+            problems = []
+            for node in walk(plan):
+                table = node.get("Relation Name")
+                if not table or name in FULL_SCANS:
+                    continue
+                seq_scan = node["Node Type"] == "Seq Scan" and table in large
+                if seq_scan:
+                    problems.append(f"seq scan on {table}")
+                if seq_scan or node.get("Rows Removed by Filter", 0) >= REMOVED_ROWS:
+                    wanted = filtered_columns(node, columns.get(table, set()))
+                    if wanted and (table, wanted[0]) not in indexed:
+                        proposals.setdefault((table, *wanted), set()).add(name)
+            if name not in FULL_SCANS:
+                cost_budget, time_budget = BUDGETS.get(
+                    name, (COST_BUDGET, TIME_BUDGET_MS)
+                )
+                if cost > cost_budget:
+                    problems.append(f"cost {cost:.0f} > {cost_budget}")
+                if elapsed > time_budget:
+                    problems.append(f"{elapsed:.2f}ms > {time_budget}ms")
+            failures.extend(f"{name}: {problem}" for problem in problems)
+            print(
+                f"  {'FAIL' if problems else 'ok':<4} {name:<30} cost {cost:10.0f}  "
+                f"{elapsed:8.2f}ms  shared hit {plan.get('Shared Hit Blocks', 0)} "
+                f"read {plan.get('Shared Read Blocks', 0)}"
+            )
+    await ConnectionManager.close_pool()
+
+    for row in foreign_keys:
+        if (row["table"], row["column"]) not in indexed:
+            proposals.setdefault((row["table"], row["column"]), set()).add(
+                "foreign key"
+            )
+    if proposals:
+        print("Proposed indexes:")
+        for (table, *index_columns), reasons in proposals.items():
+            print(
+                f"  CREATE INDEX ON {table} ({', '.join(index_columns)});"
+                f"  -- {', '.join(sorted(reasons))}"
+            )
+
+    compare_plans(plans)
+    for failure in failures:
+        print(f"FAILED {failure}")
+    print(f"{len(failures)} failures")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
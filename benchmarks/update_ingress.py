@@ -0,0 +1,162 @@
+"""
+Benchmark of update throughput, long polling against webhook
+
+Usage:
+    python -m benchmarks.update_ingress [updates] [connections]
+
+Starts a fake Bot API server on localhost, so neither Telegram nor the database is involved.
+Every update is answered with one sendMessage call to the fake server. Polling fetches the updates
+with getUpdates, in webhook mode they are posted to the webhook replica app over the given number of
+concurrent connections, as Telegram does with max_connections.
+"""
+
+import asyncio
+import itertools
+import sys
+import time
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientSession, web
+
+from settings import Settings
+from webhook import replica_app, serve
+
+TOKEN = "42:BENCHMARK"
+CHATS = 1000
+
+
+def make_update(update_id: int) -> dict:
+    chat_id = update_id % CHATS + 1
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": "статус",
+        },
+    }
+
+
+def fake_api(updates: int) -> web.Application:
+    async def get_updates(request: web.Request) -> web.Response:
+        data = await request.post()
+        offset = int(data.get("offset") or 1)
+        limit = int(data.get("limit") or 100)
+        batch = [
+            make_update(i) for i in range(offset, min(offset + limit, updates + 1))
+        ]
+        if not batch:
+            await asyncio.sleep(0.1)
+        return web.json_response({"ok": True, "result": batch})
+
+    async def send_message(request: web.Request) -> web.Response:
+        data = await request.post()
+        chat_id = int(data["chat_id"])
+        return web.json_response(
+            {
+                "ok": True,
+                "result": {
+                    "message_id": 1,
+                    "date": 0,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": data["text"],
+                },
+            }
+        )
+
+    async def get_me(request: web.Request) -> web.Response:
+        return web.json_response(
+            {"ok": True, "result": {"id": 42, "is_bot": True, "first_name": "bench"}}
+        )
+
+    app = web.Application()
+    app.router.add_post(f"/bot{TOKEN}/getMe", get_me)
+    app.router.add_post(f"/bot{TOKEN}/getUpdates", get_updates)
+    app.router.add_post(f"/bot{TOKEN}/sendMessage", send_message)
+    return app
+
+
+async def start(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def make_dispatcher(updates: int) -> tuple[Dispatcher, asyncio.Event]:
+    dp = Dispatcher()
+    done = asyncio.Event()
+    handled = itertools.count(1)
+
+    async def reply(message: types.Message, bot: Bot):
+        await bot.send_message(message.chat.id, "ok")
+        if next(handled) == updates:
+            done.set()
+
+    dp.message.register(reply)
+    return dp, done
+
+
+async def bench_polling(bot: Bot, updates: int) -> float:
+    dp, done = make_dispatcher(updates)
+    start_time = time.perf_counter()
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+    await done.wait()
+    elapsed = time.perf_counter() - start_time
+    await dp.stop_polling()
+    await polling
+    return elapsed
+
+
+async def bench_webhook(bot: Bot, updates: int, connections: int) -> float:
+    dp, done = make_dispatcher(updates)
+    server = asyncio.create_task(serve(replica_app(dp, bot)))
+    await asyncio.sleep(0.1)
+    url = f"http://127.0.0.1:{Settings.webhook_port}{Settings.webhook_path}"
+    ids = iter(range(1, updates + 1))
+
+    async def deliver(session: ClientSession):
+        for update_id in ids:
+            async with session.post(url, json=make_update(update_id)) as response:
+                response.raise_for_status()
+
+    start_time = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(deliver(session) for _ in range(connections)))
+    await done.wait()
+    elapsed = time.perf_counter() - start_time
+    server.cancel()
+    return elapsed
+
+
+async def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    api_port, Settings.webhook_port = 18081, 18080
+    Settings.webhook_host, Settings.webhook_secret = "127.0.0.1", None
+    runner = await start(fake_api(updates), api_port)
+    session = AiohttpSession(
+        api=TelegramAPIServer.from_base(f"http://127.0.0.1:{api_port}")
+    )
+    bot = Bot(TOKEN, session=session)
+    try:
+        elapsed = await bench_polling(bot, updates)
+        print(
+            f"polling: {updates} updates in {elapsed:.2f}s, {updates / elapsed:.0f} updates/s"
+        )
+        elapsed = await bench_webhook(bot, updates, connections)
+        print(
+            f"webhook ({connections} connections): {updates} updates in {elapsed:.2f}s, "
+            f"{updates / elapsed:.0f} updates/s"
+        )
+    finally:
+        await session.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,5 +1,7 @@
+from catalog import catalog
 from database import ConnectionManager
 from logger import Logger
+from users.user_repo import UserDAO
 
 from .schemas import Building
 
@@ -7,6 +9,7 @@ from .schemas import Building
 class BuildingDAO:
     def __init__(self) -> None:
         self.connection_manager = ConnectionManager()
+        self.user_dao = UserDAO()
         self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
 
     @Logger.log_exception
@@ -14,20 +17,15 @@ class BuildingDAO:
         """
         Returns list of buildings for specified user (with prestige calculation)
         """
-        res = await self.connection_manager.fetch_objects(
-            "SELECT id, cost, name, income*(SELECT prestige FROM users WHERE telegram_id=$1) as income FROM buildings",
-            Building,
-            telegram_id,
-        )
+        prestige = await self.user_dao.get_prestige(telegram_id)
+        res = await catalog.get_buildings(prestige)
         self.logger.debug(res)
         return res
 
     @Logger.log_exception
-    async def get_building_name(self, id: int) -> str:
+    async def get_building_name(self, id: int) -> str | None:
         """
-        Returns name of the building by its ID
+        Returns name of the building by its ID, None if it doesn't exist
         """
-        async with self.connection_manager as connection:
-            return await connection.fetchval(
-                "SELECT name FROM buildings WHERE id = $1", id
-            )
+        building = await catalog.get_building(id)
+        return building.name if building else None
@@ -0,0 +1,99 @@
+"""
+Module providing in-memory cache of the static game catalog (buildings and user tasks)
+"""
+
+import asyncio
+
+from buildings.schemas import Building
+from database import ConnectionManager
+from logger import Logger
+from tasks.schema import UserTask
+
+
+class Catalog:
+    """
+    Versioned in-memory copy of the buildings and user_tasks tables.\n
+    Loaded on first use and reloaded after invalidation, which is triggered by
+    catalog_changed notifications sent by the database on every edit of those tables.\n
+    Prestige scaling is applied in python, values stored here are unscaled.
+    """
+
+    def __init__(self) -> None:
+        self.connection_manager = ConnectionManager()
+        self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
+        self.version = 0
+        self.loaded_version = -1
+        self.buildings: dict[int, Building] = {}
+        self.tasks: dict[int, UserTask] = {}
+        self.lock: asyncio.Lock | None = None
+
+    def invalidate(self, payload: str | None = None) -> None:
+        """
+        Marks the catalog as stale, it will be reloaded on next access
+        """
+        self.version += 1
+        self.logger.info(f"Catalog invalidated ({payload}), version {self.version}")
+
+    async def refresh(self) -> None:
+        """
+        Reloads the catalog if it's stale
+        """
+        if self.loaded_version == self.version:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.loaded_version == self.version:
+                return
+            version = self.version
+            async with self.connection_manager as conn:
+                buildings = await conn.named_fetch("catalog.buildings")
+                tasks = await conn.named_fetch("catalog.tasks")
+            self.buildings = {row["id"]: Building(**row) for row in buildings}
+            self.tasks = {row["id"]: UserTask(**row) for row in tasks}
+            self.loaded_version = version
+            self.logger.info(f"Catalog version {version} loaded")
+
+    async def get_buildings(self, prestige: int) -> list[Building]:
+        """
+        Returns all buildings with income scaled by prestige
+        """
+        await self.refresh()
+        return [
+            building.model_copy(update={"income": building.income * prestige})
+            for building in self.buildings.values()
+        ]
+
+    async def get_building(self, building_id: int) -> Building | None:
+        """
+        Returns unscaled building by its id, None if it doesn't exist
+        """
+        await self.refresh()
+        return self.buildings.get(building_id)
+
+    async def get_tasks(self, prestige: int) -> list[UserTask]:
+        """
+        Returns all user tasks with rewards scaled by prestige
+        """
+        await self.refresh()
+        return [self.scale_task(task, prestige) for task in self.tasks.values()]
+
+    async def get_task(self, task_id: int, prestige: int = 1) -> UserTask | None:
+        """
+        Returns user task by its id with rewards scaled by prestige, None if it doesn't exist
+        """
+        await self.refresh()
+        task = self.tasks.get(task_id)
+        return self.scale_task(task, prestige) if task else None
+
+    @staticmethod
+    def scale_task(task: UserTask, prestige: int) -> UserTask:
+        return task.model_copy(
+            update={
+                "reward": task.reward * prestige,
+                "exp_reward": task.exp_reward * prestige,
+            }
+        )
+
+
+catalog = Catalog()
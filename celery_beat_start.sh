@@ -1,3 +1,4 @@
+python tables.py migrate
 
 rm -f './celerybeat.pid'
 celery -A celery_tasks beat -l info
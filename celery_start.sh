@@ -1 +1,2 @@
-celery -A celery_tasks worker -E
+python tables.py migrate
+celery -A celery_tasks worker -E --pool threads --concurrency "${TELEGRAMBOT_WORKER_CONCURRENCY:-8}"
@@ -1,10 +1,19 @@
-import asyncio
+import time
 
 from celery import Celery
+from celery.signals import (
+    task_failure,
+    task_postrun,
+    task_prerun,
+    worker_init,
+    worker_process_shutdown,
+    worker_shutdown,
+)
 
 from logger import Logger
+from metrics import celery_task_errors, celery_task_seconds, start_metrics_server
 from settings import Settings
-from tasks.tasks_repo import UserTaskDAO
+from worker_runtime import WorkerRuntime
 
 logger = Logger("Celery").get_logger()
 conf = {
@@ -24,10 +33,14 @@ conf = {
     "worker_send_task_events": True,
     "task_send_sent_event": True,
     "task_track_started": True,
+    # Stores task name and arguments with the result, so any bot process can handle it
+    "result_extended": True,
 }
 app = Celery(
     "tasks", broker=Settings.broker, backend=Settings.backend, config_source=conf
 )
+# Start times of the running tasks by task id
+task_started: dict[str, float] = {}
 
 
 @app.task()
@@ -57,7 +70,41 @@ def start_user_task(telegram_id, task_id):
         telegram_id (int): Telegram id of the user
         task_id (int): Id of the task to be started
     """
-    logger.info(f"Finished task {task_id} for user {telegram_id}")
-    loop = asyncio.get_event_loop()
-    res = loop.run_until_complete(UserTaskDAO().task_completed(telegram_id, task_id))
-    return res
+    logger.info(
+        f"Finished task {task_id} for user {telegram_id}", extra=Logger.sampled()
+    )
+    return WorkerRuntime.get().complete_task(telegram_id, task_id)
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def stop_worker_runtime(**kwargs):
+    """
+    Releases the database pool of the worker process
+    """
+    WorkerRuntime.shutdown()
+
+
+@worker_init.connect
+def start_worker_metrics(**kwargs):
+    """
+    Serves task metrics of the worker
+    """
+    start_metrics_server(Settings.celery_metrics_port)
+
+
+@task_prerun.connect
+def task_started_metrics(task_id=None, **kwargs):
+    task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def task_finished_metrics(task_id=None, task=None, **kwargs):
+    started = task_started.pop(task_id, None)
+    if started is not None:
+        celery_task_seconds.observe(time.perf_counter() - started, task.name)
+
+
+@task_failure.connect
+def task_failed_metrics(sender=None, **kwargs):
+    celery_task_errors.inc(sender.name)
@@ -0,0 +1,94 @@
+"""
+Module providing the global currency tick (TELEGRAMBOT_CURRENCY_ACCRUAL=tick)
+"""
+
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import asyncpg
+
+from database import ConnectionManager
+from logger import Logger
+from metrics import currency_tick_chunk_seconds, currency_tick_seconds
+from settings import Settings
+from users.user_repo import UserDAO
+
+# Key of the advisory lock held by the tick leader
+CURRENCY_TICK_LOCK = 0x7469636B
+
+
+class CurrencyTicker:
+    """
+    Pays income of all users on every wall-clock aligned tick.\n
+    Every bot instance runs a ticker, but only the one holding the advisory lock ticks; the others wait
+    to take over. Ticks missed while nobody was leading are paid at once by the next tick.
+    Users are paid in id-range chunks, each a separate short transaction, so row locks are held briefly.
+    """
+
+    def __init__(self) -> None:
+        self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
+        self.user_dao = UserDAO()
+
+    async def run(self) -> None:
+        """
+        Competes for leadership and ticks while leading. Never returns, should be run as a task.
+        """
+        while True:
+            try:
+                connection = await ConnectionManager.connect()
+                try:
+                    while not await connection.fetchval(
+                        "SELECT pg_try_advisory_lock($1)", CURRENCY_TICK_LOCK
+                    ):
+                        await asyncio.sleep(Settings.currency_tick_interval)
+                    self.logger.info("Leading the currency tick")
+                    await self.lead(connection)
+                finally:
+                    await connection.close()
+            except Exception:
+                self.logger.exception("Currency tick failed")
+            await asyncio.sleep(5)
+
+    async def lead(self, lock: asyncpg.Connection) -> None:
+        """
+        Ticks on every multiple of the tick interval while the lock connection is alive
+        """
+        interval = Settings.currency_tick_interval
+        while not lock.is_closed():
+            tick_at = time.time() // interval * interval
+            last = (await self.user_dao.get_last_currency_tick()).timestamp()
+            if tick_at > last:
+                await self.tick(
+                    datetime.fromtimestamp(tick_at, timezone.utc),
+                    -int((last - tick_at) // interval),
+                )
+            await asyncio.sleep(tick_at + interval - time.time())
+
+    async def tick(self, tick_at: datetime, ticks: int) -> None:
+        start = time.perf_counter()
+        paid = 0
+        chunks = 0
+        slowest = 0.0
+        max_id = await self.user_dao.get_max_user_id()
+        for start_id in range(0, max_id + 1, Settings.currency_tick_chunk_size):
+            chunk_start = time.perf_counter()
+            paid += await self.user_dao.currency_tick(
+                tick_at, ticks, start_id, start_id + Settings.currency_tick_chunk_size
+            )
+            chunk_duration = time.perf_counter() - chunk_start
+            currency_tick_chunk_seconds.observe(chunk_duration)
+            slowest = max(slowest, chunk_duration)
+            chunks += 1
+        await self.user_dao.set_last_currency_tick(tick_at)
+        duration = time.perf_counter() - start
+        currency_tick_seconds.observe(duration)
+        self.logger.info(
+            f"Currency ticked {ticks} time(s) at {tick_at:%H:%M:%S}: {paid} users in {chunks} chunks, "
+            f"{duration:.3f}s (slowest chunk {slowest:.3f}s)",
+            extra=Logger.sampled(),
+        )
+        if duration > Settings.currency_tick_interval / 2:
+            self.logger.warning(
+                f"Currency tick took {duration:.3f}s of {Settings.currency_tick_interval}s interval"
+            )
@@ -1,53 +1,291 @@
-from typing import Type
+import asyncio
+import time
+from collections.abc import Callable
+from contextvars import ContextVar
+from typing import Any
 
 import asyncpg
 
 from logger import Logger
+from metrics import (
+    connections_opened,
+    log_query,
+    pool_wait_seconds,
+    query_errors,
+    query_seconds,
+    statement_executions,
+)
 from settings import Settings
+from statements import STATEMENTS
+
+# Connections acquired by the current task, innermost last.
+# Kept in a context variable so that a single ConnectionManager instance can be shared
+# between concurrently running handlers without them overwriting each other's connection.
+# Each entry is (pool, connection, owning task, whether this entry acquired the connection).
+_acquired: ContextVar[
+    tuple[tuple[asyncpg.Pool, asyncpg.Connection, asyncio.Task | None, bool], ...]
+] = ContextVar("acquired_connections", default=())
+
+
+class StatementConnection(asyncpg.Connection):
+    """
+    Pooled connection with the registered statements prepared, executed by their names from statements.py
+    """
+
+    __slots__ = ("_statements",)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._statements: dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+    async def prepare_statements(self) -> dict[str, Exception]:
+        """
+        Prepares every registered statement.\n
+        Statements that can't be prepared yet (e.g. before migrations) are prepared again on first use.
+        :returns: errors of the statements that failed to prepare
+        """
+        failed: dict[str, Exception] = {}
+        for name, query in STATEMENTS.items():
+            try:
+                self._statements[name] = await self.prepare(query)
+            except asyncpg.PostgresError as e:
+                failed[name] = e
+        return failed
+
+    async def statement(self, name: str) -> asyncpg.prepared_stmt.PreparedStatement:
+        prepared = self._statements.get(name)
+        if prepared is None:
+            prepared = self._statements[name] = await self.prepare(STATEMENTS[name])
+        statement_executions.inc(name)
+        return prepared
+
+    async def run_statement(self, name: str, method: str, *args) -> Any:
+        """
+        Calls the method of the named prepared statement.\n
+        A statement invalidated by a schema change is prepared again and the call is retried once,
+        unless it ran in a transaction, which the failure has already aborted.
+        """
+        try:
+            return await self.call_statement(name, method, *args)
+        except asyncpg.InvalidCachedStatementError:
+            self._statements.pop(name, None)
+            if self.is_in_transaction():
+                raise
+            return await self.call_statement(name, method, *args)
+
+    async def call_statement(self, name: str, method: str, *args) -> Any:
+        """
+        Prepared statements bypass the query loggers, so latency and errors are recorded here by statement name
+        """
+        prepared = await self.statement(name)
+        start = time.perf_counter()
+        try:
+            return await getattr(prepared, method)(*args)
+        except Exception:
+            query_errors.inc(name)
+            raise
+        finally:
+            query_seconds.observe(time.perf_counter() - start, name)
+
+    async def named_execute(self, name: str, *args) -> str:
+        """
+        Executes the named statement, returns the status of the command like execute
+        """
+        await self.run_statement(name, "fetch", *args)
+        return self._statements[name].get_statusmsg()
+
+    async def named_fetch(self, name: str, *args) -> list[asyncpg.Record]:
+        return await self.run_statement(name, "fetch", *args)
+
+    async def named_fetchrow(self, name: str, *args) -> asyncpg.Record | None:
+        return await self.run_statement(name, "fetchrow", *args)
+
+    async def named_fetchval(self, name: str, *args) -> Any:
+        return await self.run_statement(name, "fetchval", *args)
 
 
 class ConnectionManager:
+    """
+    Provides connections from the process-wide asyncpg pool.\n
+    Should be used as an async context manager: the connection is acquired on enter and released back to the pool on exit.\n
+    Every instance shares the same pool, so DAOs may freely create their own managers.
+    """
+
+    _pool: asyncpg.Pool | None = None
+    _pool_loop: asyncio.AbstractEventLoop | None = None
+    _pool_lock: asyncio.Lock | None = None
+
     def __init__(self) -> None:
-        self.pool = None
         self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
-        self.connection = asyncpg.connect()
-        self.connection.close()
+
+    @classmethod
+    async def get_pool(cls) -> asyncpg.Pool:
+        """
+        Returns the pool for the running event loop, creating it on first use.
+        """
+        loop = asyncio.get_running_loop()
+        if cls._pool is not None and cls._pool_loop is loop:
+            return cls._pool
+        if cls._pool_loop is not loop:
+            # Pools are bound to the loop they were created in
+            cls._pool, cls._pool_loop, cls._pool_lock = None, loop, asyncio.Lock()
+        async with cls._pool_lock:  # type: ignore[union-attr]
+            if cls._pool is None:
+                cls._pool = await asyncpg.create_pool(
+                    host=Settings.database_host,
+                    port=Settings.database_port,
+                    user=Settings.database_user,
+                    database=Settings.database_name,
+                    password=Settings.database_password,
+                    min_size=Settings.database_pool_min_size,
+                    max_size=Settings.database_pool_max_size,
+                    max_queries=Settings.database_pool_max_queries,
+                    max_inactive_connection_lifetime=Settings.database_pool_max_inactive_lifetime,
+                    setup=cls._setup_connection,
+                    init=cls._init_connection,
+                    connection_class=StatementConnection,
+                )
+        return cls._pool
+
+    @classmethod
+    async def close_pool(cls) -> None:
+        """
+        Gracefully closes the pool of the current process.
+        """
+        if cls._pool is not None:
+            await cls._pool.close()
+            cls._pool = None
+
+    @classmethod
+    async def connect(cls, **kwargs) -> asyncpg.Connection:
+        """
+        Opens a dedicated connection outside the pool, for session state such as LISTEN or advisory locks.
+        """
+        return await asyncpg.connect(
+            host=Settings.database_host,
+            port=Settings.database_port,
+            user=Settings.database_user,
+            database=Settings.database_name,
+            password=Settings.database_password,
+            **kwargs,
+        )
+
+    @staticmethod
+    async def _init_connection(connection: asyncpg.Connection) -> None:
+        """
+        Called by the pool once for every new connection.
+        """
+        connections_opened.inc()
+        connection.add_query_logger(log_query)
+        await connection.prepare_statements()  # type: ignore[attr-defined]
+
+    @staticmethod
+    async def _setup_connection(connection: asyncpg.Connection) -> None:
+        """
+        Called by the pool every time a connection is handed out.
+        """
+        if Settings.database_pool_health_check:
+            await connection.execute("SELECT 1")
 
     async def create_database(self):
         """
         Creates a new PostgreSQL database.
         """
 
-        self.connection = await asyncpg.connect(
+        connection = await asyncpg.connect(
             host=Settings.database_host,
             port=Settings.database_port,
             user=Settings.database_user,
             password=Settings.database_password,
         )
-        await self.connection.execute(f"CREATE DATABASE {Settings.database_name}")
-        await self.connection.close()
+        await connection.execute(f"CREATE DATABASE {Settings.database_name}")
+        await connection.close()
 
-    async def __aenter__(self) -> asyncpg.Connection:
+    async def __aenter__(self) -> StatementConnection:
+        acquired = _acquired.get()
+        task = asyncio.current_task()
+        if acquired and acquired[-1][2] is task:
+            # Nested usage within the same task reuses the outer connection,
+            # so a single call chain never holds more than one pooled connection
+            pool, connection, _, _ = acquired[-1]
+            _acquired.set(acquired + ((pool, connection, task, False),))
+            return connection
         try:
-            self.connection = await asyncpg.connect(
-                host=Settings.database_host,
-                port=Settings.database_port,
-                user=Settings.database_user,
-                database=Settings.database_name,
-                password=Settings.database_password,
+            pool = await self.get_pool()
+            start = time.perf_counter()
+            connection = await pool.acquire(
+                timeout=Settings.database_pool_acquire_timeout
             )
-            return self.connection
+            pool_wait_seconds.observe(time.perf_counter() - start)
         except Exception as e:
             self.logger.error(
                 str(e)
-                + f" with database {Settings.database_host}:{Settings.database_port}:{Settings.database_user}:{Settings.database_password}"
+                + f" with database {Settings.database_host}:{Settings.database_port}:{Settings.database_user}"
             )
+            raise
+        _acquired.set(acquired + ((pool, connection, task, True),))
+        return connection
 
     async def __aexit__(self, exc_type, exc, tb):
-        if self.connection:
-            await self.connection.close()
+        acquired = _acquired.get()
+        if not acquired:
+            return
+        pool, connection, _, owned = acquired[-1]
+        _acquired.set(acquired[:-1])
+        if owned:
+            await pool.release(connection)
+
+    async def listen(
+        self,
+        channels: dict[str, Callable[[str], None]],
+        on_connect: Callable[[], None] | None = None,
+    ) -> None:
+        """
+        Keeps a dedicated connection subscribed to LISTEN/NOTIFY channels, reconnecting on failure.\n
+        Callbacks receive the notification payload; on_connect is called after every (re)subscription,
+        as notifications sent while disconnected are lost. Never returns, should be run as a task.
+        """
+        while True:
+            try:
+                connection = await self.connect()
+                try:
+                    closed = asyncio.Event()
+                    connection.add_termination_listener(
+                        lambda _, closed=closed: closed.set()
+                    )
+                    for channel, callback in channels.items():
+                        await connection.add_listener(
+                            channel,
+                            lambda _conn, _pid, _channel, payload, callback=callback: (
+                                callback(payload)
+                            ),
+                        )
+                    self.logger.info(f"Listening to {', '.join(channels)}")
+                    if on_connect:
+                        on_connect()
+                    await closed.wait()
+                    self.logger.warning("Notifications connection closed")
+                finally:
+                    await connection.close()
+            except Exception:
+                self.logger.exception("Notifications connection failed")
+            await asyncio.sleep(5)
+
+    async def check_statements(self) -> dict[str, Exception]:
+        """
+        Prepares every registered statement on a new connection, so statements broken by schema changes are found on startup
+        :returns: errors of the statements that failed to prepare
+        """
+        connection = await self.connect(connection_class=StatementConnection)
+        try:
+            failed = await connection.prepare_statements()
+        finally:
+            await connection.close()
+        for name, error in failed.items():
+            self.logger.error(f"Statement {name} can't be prepared: {error}")
+        return failed
 
-    async def fetch_objects(self, query: str, cls: Type, *args):
+    async def fetch_objects(self, query: str, cls: type, *args):
         """
         Convenience method for fetching objects of a given type from the database
         """
@@ -71,13 +309,14 @@ class ConnectionManager:
         Drops the PostgreSQL database.
         """
         try:
-            self.connection = await asyncpg.connect(
+            await self.close_pool()
+            connection = await asyncpg.connect(
                 host=Settings.database_host,
                 port=Settings.database_port,
                 user=Settings.database_user,
                 password=Settings.database_password,
             )
-            await self.connection.execute(f"DROP DATABASE {Settings.database_name}")
-            await self.connection.close()
+            await connection.execute(f"DROP DATABASE {Settings.database_name}")
+            await connection.close()
         except Exception as e:
             self.logger.error(str(e))
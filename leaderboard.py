@@ -0,0 +1,194 @@
+"""
+Module providing the player leaderboards (TELEGRAMBOT_LEADERBOARD_REDIS)
+
+Every board is a redis sorted set of telegram ids scored by one stat. UserDAO queues an update whenever it
+changes a stat, and queued updates are written in the background, so the write path never waits for redis.
+The top of a board and the rank of a player are read in O(log n) without touching users.
+Boards drift from the database (income accrual, task costs and rewards are not tracked, updates fail
+while redis is down), so the process holding the advisory lock rebuilds them from the database
+every reconcile interval.
+"""
+
+import asyncio
+import time
+
+import asyncpg
+import redis.asyncio as aioredis
+
+from database import ConnectionManager
+from logger import Logger
+from settings import Settings
+
+# Board names and their titles, stats are stored in the users columns of the same name
+BOARDS = {
+    "currency": "Деньги",
+    "income": "Доход",
+    "prestige": "Престиж",
+    "lvl": "Уровень",
+}
+
+# Key of the advisory lock held by the process reconciling the boards
+LEADERBOARD_LOCK = 0x6C647262
+
+
+class Leaderboard:
+    """
+    Redis sorted sets ranking players by every stat of BOARDS.\n
+    Does nothing if redis is not configured.
+    """
+
+    def __init__(self) -> None:
+        self.connection_manager = ConnectionManager()
+        self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
+        self._client: aioredis.Redis | None = None
+        # Scores waiting to be written, the latest ones per player and board
+        self.pending: dict[int, dict[str, int]] = {}
+        self.writer: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(Settings.leaderboard_redis)
+
+    @property
+    def client(self) -> aioredis.Redis | None:
+        """
+        Redis client, created on first use
+        """
+        if self._client is None and self.enabled:
+            self._client = aioredis.from_url(Settings.leaderboard_redis)
+        return self._client
+
+    @staticmethod
+    def key(board: str) -> str:
+        return f"leaderboard:{board}"
+
+    def update(self, telegram_id: int, **scores: int) -> None:
+        """
+        Queues scores of the player on the given boards, e.g. update(telegram_id, currency=100)
+        """
+        self.update_many({telegram_id: scores})
+
+    def update_many(self, players: dict[int, dict[str, int]]) -> None:
+        """
+        Queues scores of several players, they are written by a background task in one round trip.\n
+        Best effort: failed writes are only logged, the boards are fixed by the next reconciliation.
+        """
+        if not self.enabled or not players:
+            return
+        for telegram_id, scores in players.items():
+            self.pending.setdefault(telegram_id, {}).update(scores)
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self.write())
+
+    async def write(self) -> None:
+        while self.pending and self.client is not None:
+            players, self.pending = self.pending, {}
+            try:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for telegram_id, scores in players.items():
+                        for board, score in scores.items():
+                            pipe.zadd(self.key(board), {str(telegram_id): score})
+                    await pipe.execute()
+            except aioredis.RedisError as e:
+                self.logger.warning(
+                    f"Leaderboard update failed for {len(players)} players: {e}",
+                    extra=Logger.sampled(),
+                )
+
+    async def view(
+        self, board: str, telegram_id: int, count: int
+    ) -> tuple[list[tuple[int, int]], tuple[int, int] | None] | None:
+        """
+        Reads the best players of the board and the place of the player in one round trip
+        :returns: telegram ids and scores of the top, 1-based place and score of the player
+        (None if the player isn't ranked yet), None if the leaderboards are unavailable
+        """
+        if self.client is None:
+            return None
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.zrevrange(self.key(board), 0, count - 1, withscores=True)
+                pipe.zrevrank(self.key(board), str(telegram_id))
+                pipe.zscore(self.key(board), str(telegram_id))
+                rows, place, score = await pipe.execute()
+        except aioredis.RedisError as e:
+            self.logger.warning(f"Leaderboard read failed: {e}", extra=Logger.sampled())
+            return None
+        top = [(int(member), int(score)) for member, score in rows]
+        return top, None if place is None else (place + 1, int(score))
+
+    async def reconcile(self) -> int:
+        """
+        Rebuilds every board from the database into new keys, reading users in id order in chunks,
+        and swaps them in at once, which also drops deleted players.\n
+        Updates made while rebuilding may be lost until the player's next change.
+        :returns: number of ranked players
+        """
+        # UserDAO queues board updates, so it imports this module
+        from users.user_repo import UserDAO
+
+        if self.client is None:
+            return 0
+        start = time.perf_counter()
+        last_id = 0
+        players = 0
+        await self.client.delete(*(self.key(board) + ":rebuild" for board in BOARDS))
+        while True:
+            async with self.connection_manager as conn:
+                rows = await conn.named_fetch(
+                    "leaderboard.scores",
+                    last_id,
+                    Settings.leaderboard_chunk_size,
+                    UserDAO.accrual_interval(),
+                )
+            if not rows:
+                break
+            async with self.client.pipeline(transaction=False) as pipe:
+                for board in BOARDS:
+                    pipe.zadd(
+                        self.key(board) + ":rebuild",
+                        {str(row["telegram_id"]): row[board] for row in rows},
+                    )
+                await pipe.execute()
+            last_id = rows[-1]["id"]
+            players += len(rows)
+        async with self.client.pipeline(transaction=True) as pipe:
+            for board in BOARDS:
+                if players:
+                    pipe.rename(self.key(board) + ":rebuild", self.key(board))
+                else:
+                    pipe.delete(self.key(board))
+            await pipe.execute()
+        self.logger.info(
+            f"Leaderboards rebuilt: {players} players in {time.perf_counter() - start:.3f}s"
+        )
+        return players
+
+    async def run(self) -> None:
+        """
+        Reconciles the boards periodically while holding the advisory lock, so replicas never rebuild
+        the same keys at once; the others wait to take over. Never returns, should be run as a task.
+        """
+        while True:
+            try:
+                connection = await ConnectionManager.connect()
+                try:
+                    while not await connection.fetchval(
+                        "SELECT pg_try_advisory_lock($1)", LEADERBOARD_LOCK
+                    ):
+                        await asyncio.sleep(Settings.leaderboard_reconcile_interval)
+                    self.logger.info("Leading the leaderboard reconciliation")
+                    while not connection.is_closed():
+                        try:
+                            await self.reconcile()
+                        except (aioredis.RedisError, asyncpg.PostgresError):
+                            self.logger.exception("Leaderboard reconciliation failed")
+                        await asyncio.sleep(Settings.leaderboard_reconcile_interval)
+                finally:
+                    await connection.close()
+            except Exception:
+                self.logger.exception("Leaderboard reconciliation lock failed")
+            await asyncio.sleep(5)
+
+
+leaderboard = Leaderboard()
@@ -2,9 +2,12 @@
 Module for logging in the application, provides Logger class which logs into the stdout and log directory defined in the configuration
 """
 
-import datetime
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
 from functools import wraps
 
 import colorlog
@@ -36,19 +39,83 @@ if not os.path.exists(log_dir):  # type: ignore[arg-type]
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
 
-# Хендлер для файла последнего запуска с режимом 'w' (write)
+# Хендлер для файла последнего запуска с режимом 'w' (write),
+# дочерние процессы дописывают в файл своего родителя
 last_startup_file_handler = logging.FileHandler(
     os.path.join(log_dir, "last_startup.log"),  # type: ignore[arg-type]
-    mode="w",  # type: ignore[arg-type]
+    mode="w" if multiprocessing.parent_process() is None else "a",
 )
 last_startup_file_handler.setFormatter(file_format)
 
-# Хендлер для файла с текущей датой с режимом 'a' (append)
-date_file_handler = logging.FileHandler(
-    os.path.join(log_dir, f"{datetime.datetime.now().strftime('%Y-%m-%d')}.log"),  # type: ignore[arg-type]
-    mode="a",
+# Хендлер для общего файла с ротацией по размеру, либо каждую полночь.
+# Ротация небезопасна для нескольких процессов, поэтому у дочерних процессов свой файл (bot.bot-worker-0.log)
+log_file = os.path.join(
+    log_dir,  # type: ignore[arg-type]
+    "bot.log"
+    if multiprocessing.parent_process() is None
+    else f"bot.{multiprocessing.current_process().name}.log",
 )
-date_file_handler.setFormatter(file_format)
+if Settings.log_max_bytes:
+    rotating_file_handler: logging.Handler = logging.handlers.RotatingFileHandler(
+        log_file,
+        maxBytes=Settings.log_max_bytes,
+        backupCount=Settings.log_backup_count,
+    )
+else:
+    rotating_file_handler = logging.handlers.TimedRotatingFileHandler(
+        log_file,
+        when="midnight",
+        backupCount=Settings.log_backup_count,
+    )
+rotating_file_handler.setFormatter(file_format)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only every n-th record of a call site, for records logged with extra=Logger.sampled().\n
+    Other records are always passed.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.counters: dict[tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        every = getattr(record, "sample_every", 1)
+        if every <= 1:
+            return True
+        site = (record.pathname, record.lineno)
+        count = self.counters.get(site, 0)
+        self.counters[site] = count + 1
+        return not count % every
+
+
+class SamplingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler marking sampled records on the copy it enqueues, the record itself is left untouched
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        every = getattr(record, "sample_every", 1)
+        if every > 1:
+            record.msg = record.message = f"{record.message} (1 of {every} sampled)"
+        return record
+
+
+# Логгеры только кладут записи в очередь, форматирование и запись выполняются в отдельном потоке
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+queue_handler = SamplingQueueHandler(log_queue)
+queue_handler.addFilter(SamplingFilter())
+queue_listener = logging.handlers.QueueListener(
+    log_queue,
+    stream_handler,
+    last_startup_file_handler,
+    rotating_file_handler,
+)
+queue_listener.start()
+# Записи, оставшиеся в очереди, дописываются при выходе
+atexit.register(queue_listener.stop)
 
 
 class Logger:
@@ -65,12 +132,11 @@ class Logger:
         Initialize logger with provided name
         """
         self.logger = logging.getLogger(name)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(Settings.log_levels.get(name, Settings.log_level))
 
-        # Добавление уже созданных хендлеров к логгеру
-        self.logger.addHandler(stream_handler)
-        self.logger.addHandler(last_startup_file_handler)
-        self.logger.addHandler(date_file_handler)
+        # Хендлер добавляется один раз, сколько бы экземпляров Logger ни создавалось
+        if queue_handler not in self.logger.handlers:
+            self.logger.addHandler(queue_handler)
 
     def get_logger(self):
         """
@@ -78,6 +144,15 @@ class Logger:
         """
         return self.logger
 
+    @staticmethod
+    def sampled(every: int | None = None) -> dict[str, int]:
+        """
+        Extra for hot path records, only every n-th record of the call site is logged
+        (TELEGRAMBOT_LOG_SAMPLE_EVERY by default)\n
+        Usage: logger.info("...", extra=Logger.sampled())
+        """
+        return {"sample_every": every or Settings.log_sample_every}
+
     @staticmethod
     def log_exception(func):
         """
@@ -6,15 +6,23 @@ from aiogram.filters import CommandStart
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
 from buildings.buildings_repo import BuildingDAO
+from catalog import catalog
 from celery_tasks import await_check_init, start_user_task
+from currency_ticker import CurrencyTicker
 from database import ConnectionManager
+from leaderboard import BOARDS, leaderboard
 from logger import Logger
+from metrics import Gauge, TelegramRequestMetrics, start_metrics_server, track_handler
 from middleware import LoginMiddleware
+from outbox import Outbox
 from settings import Settings
+from supervisor import run_supervisor
 from task_manager import TaskManager
 from tasks.tasks_repo import TaskStatus, UserTaskDAO
 from users.level_rewards import REWARD_DICT
+from users.user_cache import registered_users
 from users.user_repo import UserDAO
+from webhook import run_webhook
 
 
 class MyBasicKeyboard:
@@ -25,7 +33,8 @@ class MyBasicKeyboard:
         self.keyboard.add(types.KeyboardButton(text="Обновить"))
         self.keyboard.add(types.KeyboardButton(text="Престиж"))
         self.keyboard.add(types.KeyboardButton(text="Задачи"))
-        self.keyboard.adjust(2, 3)
+        self.keyboard.add(types.KeyboardButton(text="Рейтинг"))
+        self.keyboard.adjust(2, 3, 1)
 
     def get_keyboard(self):
         res = self.keyboard.as_markup()
@@ -34,15 +43,60 @@ class MyBasicKeyboard:
 
 
 class Game:
-    def __init__(self, dp: Dispatcher):
+    """
+    Bot handlers and background duties.\n
+    When updates are sharded between several processes, only the leader runs singleton duties
+    (currency ticking, task sweeping, leaderboard reconciliation and task result handling), and the outbox rate is split between processes.
+    """
+
+    def __init__(
+        self, dp: Dispatcher, bot: Bot, leader: bool = True, processes: int = 1
+    ):
         self.user_dao = UserDAO()
         self.building_dao = BuildingDAO()
         self.user_task_dao = UserTaskDAO()
-        self.task_manager = TaskManager()
+        self.task_manager = TaskManager(handle_results=leader)
+        self.task_manager.on_result(
+            start_user_task, self.callback_for_completed_user_tasks
+        )
         self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
         self.dp = dp
+        self.bot = bot
+        self.outbox = Outbox(bot, Settings.outbox_global_rate / processes)
+        Gauge(
+            "bot_pending_celery_tasks",
+            "Celery tasks waiting for their result callback",
+            lambda: len(self.task_manager.tasks),
+        )
+        Gauge(
+            "bot_outbox_depth", "Messages waiting to be sent", lambda: self.outbox.depth
+        )
+        self.currency_ticker = CurrencyTicker()
         self.register_handlers()
-        asyncio.create_task(self.currency_ticking())
+        asyncio.create_task(
+            ConnectionManager().listen(
+                {
+                    "users_changed": registered_users.on_users_changed,
+                    "catalog_changed": catalog.invalidate,
+                },
+                on_connect=self.on_notifications_connected,
+            )
+        )
+        if not leader:
+            return
+        if self.user_dao.accrual_interval() is None:
+            asyncio.create_task(self.currency_ticker.run())
+        if Settings.user_task_scheduler == "postgres":
+            asyncio.create_task(self.task_sweeping())
+        if leaderboard.enabled:
+            asyncio.create_task(leaderboard.run())
+
+    def on_notifications_connected(self):
+        """
+        Drops in-memory caches, as notifications might have been missed while disconnected
+        """
+        registered_users.clear()
+        catalog.invalidate()
 
     def register_handlers(self):
         """
@@ -52,150 +106,295 @@ class Game:
         start_router = Router(name="start")
         start_router.message.register(self.start, CommandStart())
         logged_router = Router(name="main")
-        logged_router.message.middleware(LoginMiddleware("message"))
-        logged_router.callback_query.middleware(LoginMiddleware("callback"))
+        logged_router.message.middleware(LoginMiddleware("message", self.outbox))
+        logged_router.callback_query.middleware(
+            LoginMiddleware("callback", self.outbox)
+        )
         logged_router.message.register(self.balance, F.text.lower() == "статус")
         logged_router.message.register(self.update, F.text.lower() == "обновить")
         logged_router.message.register(self.prestige_show, F.text.lower() == "престиж")
         logged_router.message.register(self.tasks_list, F.text.lower() == "задачи")
+        logged_router.message.register(
+            self.leaderboard_show, F.text.lower() == "рейтинг"
+        )
         logged_router.message.register(
             self.message_buildings_list, F.text.lower() == "список зданий"
         )
         logged_router.callback_query.register(
             self.buildings_list, F.data == "buildings_list"
         )
+        logged_router.callback_query.register(
+            self.buildings_page, F.data.startswith("buildings_page_")
+        )
         logged_router.callback_query.register(
             self.buy_building, F.data.startswith("buy_")
         )
+        logged_router.callback_query.register(
+            self.tasks_page, F.data.startswith("tasks_page_")
+        )
         logged_router.callback_query.register(
             self.start_task, F.data.startswith("task_")
         )
         logged_router.callback_query.register(self.prestige_buy, F.data == "prestige")
+        logged_router.callback_query.register(
+            self.leaderboard_board, F.data.startswith("leaderboard_")
+        )
         self.dp.include_router(start_router)
         self.dp.include_router(logged_router)
 
+    @track_handler
     @Logger.log_exception
     async def start_task(self, callback: types.CallbackQuery):
         task_id = int(callback.data.split("_")[1])
-        task = await self.user_task_dao.get_task(callback.from_user.id, task_id)
-        can_afford = await self.user_task_dao.can_afford(callback.from_user.id, task_id)
+        started = await self.user_task_dao.start_task(callback.from_user.id, task_id)
+        if not started:
+            self.logger.warning(f"Unrecognizable task in start task: {task_id}")
+            await callback.answer()
+            return
+        can_afford, task, active_task = started
         if can_afford == TaskStatus.NOT_ENOUGH_MONEY:
-            await callback.message.answer("У вас недостаточно денег.")
+            self.outbox.send(callback.message.chat.id, "У вас недостаточно денег.")
             await callback.answer()
             return
         if can_afford == TaskStatus.INSUFFICIENT_LEVEL:
-            await callback.message.answer("Ваш уровень слишком низкий.")
+            self.outbox.send(callback.message.chat.id, "Ваш уровень слишком низкий.")
             await callback.answer()
             return
         if can_afford == TaskStatus.ALREADY_EXECUTED:
-            active_task_id = await self.user_task_dao.get_active_user_task(
-                callback.from_user.id
-            )
-            active_task = await self.user_task_dao.get_task(
-                callback.from_user.id, active_task_id
-            )
-            await callback.message.answer(
-                f"Вы уже выполняете задачу: {active_task.name}"
+            self.outbox.send(
+                callback.message.chat.id,
+                f"Вы уже выполняете задачу: {active_task.name if active_task else ''}",
             )
             await callback.answer()
             return
-        await self.user_dao.update_currency(callback.from_user.id, task.cost * (-1))
-        await self.user_task_dao.start_task(callback.from_user.id, task_id)
-        self.task_manager.apply_with_delay(
-            start_user_task,
-            delay=task.length * Settings.currency_tick_interval,
-            args=(callback.from_user.id, task_id),
-            callback=self.callback_for_completed_user_tasks,
-            args_for_callback=(callback.from_user.id, task_id, callback),
+        if Settings.user_task_scheduler == "celery":
+            self.task_manager.apply_with_delay(
+                start_user_task,
+                delay=task.length * Settings.currency_tick_interval,
+                args=(callback.from_user.id, task_id),
+            )
+        self.logger.info(
+            f"Task {task_id} started for user {callback.from_user.id}",
+            extra=Logger.sampled(),
         )
-        self.logger.info(f"Task {task_id} started for user {callback.from_user.id}")
-        await callback.message.answer("Задача началась")
+        self.outbox.send(callback.message.chat.id, "Задача началась")
         await callback.answer()
 
-    async def callback_for_completed_user_tasks(
-        self, res, telegram_id, task_id, callback: types.CallbackQuery
-    ):
-        await callback.message.answer("Задача выполнена")
+    async def callback_for_completed_user_tasks(self, res, telegram_id, task_id):
+        if isinstance(res, BaseException):
+            self.logger.error(f"Task {task_id} failed for user {telegram_id}: {res!r}")
+            self.outbox.send(telegram_id, "Не удалось выполнить задачу")
+            return
+        self.outbox.send(telegram_id, "Задача выполнена")
         if res:
-            await callback.message.answer(
-                f"Уровень повышен! Ваша награда: {REWARD_DICT.get(res).to_user()}"
+            rewards = [
+                REWARD_DICT[level].to_user() for level in res if level in REWARD_DICT
+            ]
+            self.outbox.send(
+                telegram_id,
+                f"Уровень повышен до {res[-1]}! Ваша награда: {', '.join(rewards)}",
             )
-        self.logger.info(f"Task {task_id} completed for user {telegram_id}")
+        self.logger.info(
+            f"Task {task_id} completed for user {telegram_id}", extra=Logger.sampled()
+        )
 
-    @Logger.log_exception
-    async def tasks_list(self, message: types.Message):
-        tasks = await self.user_task_dao.get_tasks(message.from_user.id)
-        for task in tasks:
-            kb = InlineKeyboardBuilder()
-            kb.add(
+    @staticmethod
+    def page_keyboard(
+        buttons: list[types.InlineKeyboardButton], page: int, pages: int, prefix: str
+    ) -> types.InlineKeyboardMarkup:
+        """
+        Builds keyboard with one button per row and a navigation row for the page
+        """
+        keyboard = InlineKeyboardBuilder()
+        for button in buttons:
+            keyboard.row(button)
+        navigation = []
+        if page > 0:
+            navigation.append(
                 types.InlineKeyboardButton(
-                    text="Выполнить", callback_data=f"task_{task.id}"
+                    text="◀", callback_data=f"{prefix}_page_{page - 1}"
                 )
             )
-            await message.answer(task.get_info(), reply_markup=kb.as_markup())
-        active_task_id = await self.user_task_dao.get_active_user_task(
-            message.from_user.id
-        )
-        if active_task_id:
+        if page < pages - 1:
+            navigation.append(
+                types.InlineKeyboardButton(
+                    text="▶", callback_data=f"{prefix}_page_{page + 1}"
+                )
+            )
+        if navigation:
+            keyboard.row(*navigation)
+        return keyboard.as_markup()
+
+    @staticmethod
+    def page_slice(items: list, page: int) -> tuple[list, int, int]:
+        """
+        Returns items of the page, the page number clamped to the valid range and the number of pages
+        """
+        size = Settings.catalog_page_size
+        pages = max(1, -(-len(items) // size))
+        page = min(max(page, 0), pages - 1)
+        return items[page * size : (page + 1) * size], page, pages
+
+    async def render_tasks_page(
+        self, telegram_id: int, page: int
+    ) -> tuple[str, types.InlineKeyboardMarkup]:
+        """
+        Renders one page of the tasks screen
+        """
+        snapshot = await self.user_dao.get_player_snapshot(telegram_id)
+        tasks = await self.user_task_dao.get_tasks(telegram_id, snapshot.prestige)
+        tasks, page, pages = self.page_slice(tasks, page)
+        lines = [f"Задачи ({page + 1}/{pages}):"]
+        lines.extend(task.get_info() for task in tasks)
+        if snapshot.active_task_id:
             active_task = await self.user_task_dao.get_task(
-                message.from_user.id, active_task_id
+                telegram_id, snapshot.active_task_id, snapshot.prestige
             )
-            await message.answer(f"Текущая задача: {active_task.name}")
+            if active_task:
+                lines.append(f"Текущая задача: {active_task.name}")
+        buttons = [
+            types.InlineKeyboardButton(
+                text=f"Выполнить: {task.name}", callback_data=f"task_{task.id}"
+            )
+            for task in tasks
+        ]
+        return "\n".join(lines), self.page_keyboard(buttons, page, pages, "tasks")
+
+    async def render_leaderboard(
+        self, telegram_id: int, board: str
+    ) -> tuple[str, types.InlineKeyboardMarkup]:
+        """
+        Renders the top of the board with the place of the player
+        """
+        view = await leaderboard.view(board, telegram_id, Settings.leaderboard_size)
+        lines = [f"Рейтинг: {BOARDS[board]}"]
+        if view is None:
+            lines.append("Рейтинг временно недоступен, попробуйте позже")
+            view = [], None
+        top, rank = view
+        for place, (player, score) in enumerate(top, 1):
+            name = "Вы" if player == telegram_id else f"Игрок …{str(player)[-4:]}"
+            lines.append(f"{place}. {name}: {score}")
+        if rank:
+            lines.append(f"Ваше место: {rank[0]} ({rank[1]})")
+        keyboard = InlineKeyboardBuilder()
+        for name, title in BOARDS.items():
+            if name != board:
+                keyboard.add(
+                    types.InlineKeyboardButton(
+                        text=title, callback_data=f"leaderboard_{name}"
+                    )
+                )
+        return "\n".join(lines), keyboard.as_markup()
 
+    @track_handler
+    @Logger.log_exception
+    async def leaderboard_show(self, message: types.Message):
+        if not leaderboard.enabled:
+            self.outbox.send(message.chat.id, "Рейтинг недоступен")
+            return
+        text, keyboard = await self.render_leaderboard(message.from_user.id, "currency")
+        self.outbox.send(message.chat.id, text, reply_markup=keyboard)
+
+    @track_handler
+    @Logger.log_exception
+    async def leaderboard_board(self, callback: types.CallbackQuery):
+        board = callback.data.removeprefix("leaderboard_")
+        if board not in BOARDS or not leaderboard.enabled:
+            await callback.answer()
+            return
+        text, keyboard = await self.render_leaderboard(callback.from_user.id, board)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+
+    @track_handler
+    @Logger.log_exception
+    async def tasks_list(self, message: types.Message):
+        text, keyboard = await self.render_tasks_page(message.from_user.id, 0)
+        self.outbox.send(message.chat.id, text, reply_markup=keyboard)
+
+    @track_handler
+    @Logger.log_exception
+    async def tasks_page(self, callback: types.CallbackQuery):
+        page = int(callback.data.split("_")[2])
+        text, keyboard = await self.render_tasks_page(callback.from_user.id, page)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+
+    @track_handler
     @Logger.log_exception
     async def prestige_buy(self, callback: types.CallbackQuery):
         prestige = await self.user_dao.get_prestige(callback.from_user.id)
-        cur = await self.user_dao.get_currency(callback.from_user.id)
-        if cur < Settings.prestige_formula(prestige):
-            await callback.message.answer(
-                "У вас недостаточно денег для покупки престижа."
+        if not await self.user_dao.prestige_up(callback.from_user.id, prestige):
+            self.outbox.send(
+                callback.message.chat.id,
+                "У вас недостаточно денег для покупки престижа.",
             )
             await callback.answer()
             return
-        await self.user_dao.prestige_up(callback.from_user.id)
-        await callback.message.answer("Престиж получен")
+        self.outbox.send(callback.message.chat.id, "Престиж получен")
         await callback.answer()
 
+    @track_handler
     @Logger.log_exception
     async def prestige_show(self, message: types.Message):
         prestige = await self.user_dao.get_prestige(message.from_user.id)
-        await message.answer(f"Ваш престиж: {prestige}")
+        self.outbox.send(message.chat.id, f"Ваш престиж: {prestige}")
         keyboard = InlineKeyboardBuilder()
         keyboard.add(
             types.InlineKeyboardButton(text="Престиж", callback_data="prestige")
         )
-        await message.answer(
+        self.outbox.send(
+            message.chat.id,
             f"Цена престижа: {Settings.prestige_formula(prestige)}",
             reply_markup=keyboard.as_markup(),
         )
 
+    @track_handler
     @Logger.log_exception
     async def update(self, message: types.Message):
-        await message.answer(
-            "Обновление клавиатуры", reply_markup=MyBasicKeyboard().get_keyboard()
+        self.outbox.send(
+            message.chat.id,
+            "Обновление клавиатуры",
+            reply_markup=MyBasicKeyboard().get_keyboard(),
+        )
+        self.logger.info(
+            f"User {message.from_user.id} updated keyboard", extra=Logger.sampled()
         )
-        self.logger.info(f"User {message.from_user.id} updated keyboard")
 
+    async def render_buildings_page(
+        self, telegram_id: int, page: int
+    ) -> tuple[str, types.InlineKeyboardMarkup]:
+        """
+        Renders one page of the buildings screen
+        """
+        buildings = await self.building_dao.list_buildings(telegram_id)
+        buildings, page, pages = self.page_slice(buildings, page)
+        lines = [f"Здания ({page + 1}/{pages}):"]
+        lines.extend(str(building.get_info()) for building in buildings)
+        buttons = [
+            types.InlineKeyboardButton(
+                text=f"Купить: {building.name}", callback_data=f"buy_{building.id}"
+            )
+            for building in buildings
+        ]
+        return "\n".join(lines), self.page_keyboard(buttons, page, pages, "buildings")
+
+    @track_handler
     @Logger.log_exception
     async def message_buildings_list(self, message: types.Message):
-        buildings = await self.building_dao.list_buildings(message.from_user.id)
-        for building in buildings:
-            keyboard = InlineKeyboardBuilder()
-            keyboard.add(
-                types.InlineKeyboardButton(
-                    text=str("Купить"), callback_data=f"buy_{str(building.id)}"
-                )
-            )
-            await message.answer(
-                str(building.get_info()), reply_markup=keyboard.as_markup()
-            )
+        text, keyboard = await self.render_buildings_page(message.from_user.id, 0)
+        self.outbox.send(message.chat.id, text, reply_markup=keyboard)
 
+    @track_handler
     @Logger.log_exception
     async def start(self, message: types.Message):
         """
         User registration method
         """
-        self.logger.info(f"Starting user {message.from_user.id}...")
+        self.logger.info(
+            f"Starting user {message.from_user.id}...", extra=Logger.sampled()
+        )
         telegram_id = message.from_user.id
         exists = await self.user_dao.check_user(telegram_id)
         keyboard = InlineKeyboardBuilder()
@@ -204,35 +403,41 @@ class Game:
                 text="Список зданий", callback_data="buildings_list"
             )
         )
+        registered_users.set(telegram_id, exists)
         if exists:
-            await message.answer(
-                "Вы уже зарегистрированы", reply_markup=MyBasicKeyboard().get_keyboard()
+            self.outbox.send(
+                message.chat.id,
+                "Вы уже зарегистрированы",
+                reply_markup=MyBasicKeyboard().get_keyboard(),
             )
             self.logger.info(f"User {message.from_user.id} already exists")
             return
 
         await self.user_dao.register_user(telegram_id)
-        await message.answer(
+        registered_users.set(telegram_id, True)
+        self.outbox.send(
+            message.chat.id,
             "Привет! Я бот, для игры в simplegame (Название придумаю потом)",
             reply_markup=MyBasicKeyboard().get_keyboard(),
         )
         self.logger.info(f"User {message.from_user.id} registered")
 
+    @track_handler
     @Logger.log_exception
     async def buildings_list(self, callback: types.CallbackQuery):
-        buildings = await self.building_dao.list_buildings(callback.from_user.id)
-        for building in buildings:
-            keyboard = InlineKeyboardBuilder()
-            keyboard.add(
-                types.InlineKeyboardButton(
-                    text=str("Купить"), callback_data=f"buy_{str(building.id)}"
-                )
-            )
-            await callback.message.answer(
-                str(building.get_info()), reply_markup=keyboard.as_markup()
-            )
+        text, keyboard = await self.render_buildings_page(callback.from_user.id, 0)
+        self.outbox.send(callback.message.chat.id, text, reply_markup=keyboard)
         await callback.answer()
 
+    @track_handler
+    @Logger.log_exception
+    async def buildings_page(self, callback: types.CallbackQuery):
+        page = int(callback.data.split("_")[2])
+        text, keyboard = await self.render_buildings_page(callback.from_user.id, page)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+
+    @track_handler
     @Logger.log_exception
     async def buy_building(self, callback: types.CallbackQuery):
         building_id = int(callback.data.split("_")[1])
@@ -242,62 +447,120 @@ class Game:
         if not building_id:
             self.logger.warning("Unrecognizable data in buy building")
         telegram_id = callback.from_user.id
-        if await self.user_dao.buy_building(telegram_id, building_id):
-            await callback.message.answer(
-                f"Вы купили здание {await self.building_dao.get_building_name(building_id)}"
-            )
-            new_status = await self.user_dao.get_currency_status(telegram_id)
-            await callback.message.answer(
-                f"Ваш баланс: {new_status[0]}$ + ({new_status[1]}$\мин)"
+        name = await self.building_dao.get_building_name(building_id)
+        if name is None:
+            self.logger.warning(f"Unknown building in buy building: {building_id}")
+            self.outbox.send(callback.message.chat.id, "Это здание больше недоступно.")
+            await callback.answer()
+            return
+        bought = await self.user_dao.buy_building(telegram_id, building_id)
+        if bought:
+            currency, income = bought
+            self.outbox.send(callback.message.chat.id, f"Вы купили здание {name}")
+            self.outbox.send(
+                callback.message.chat.id, f"Ваш баланс: {currency}$ + ({income}$\\мин)"
             )
             self.logger.info(
                 f"User {callback.from_user.id} bought building {building_id}"
             )
         else:
-            await callback.message.answer(
-                f"Вы не можете купить здание {await self.building_dao.get_building_name(building_id)}"
+            self.outbox.send(
+                callback.message.chat.id, f"Вы не можете купить здание {name}"
             )
 
         await callback.answer()
 
+    @track_handler
     @Logger.log_exception
     async def balance(self, message: types.Message):
-        user_id = message.from_user.id
-        balance, income = await self.user_dao.get_currency_status(user_id)
-        level, exp, max_exp = await self.user_dao.get_level(user_id)
-        await message.answer(f"Ваш баланс: {balance}$ + ({income}$\мин)")
-        await message.answer(f"Ваш уровень: {level} [{exp}/{max_exp}]")
+        snapshot = await self.user_dao.get_player_snapshot(message.from_user.id)
+        self.outbox.send(
+            message.chat.id,
+            f"Ваш баланс: {snapshot.currency}$ + ({snapshot.income}$\\мин)",
+        )
+        self.outbox.send(
+            message.chat.id,
+            f"Ваш уровень: {snapshot.level} [{snapshot.xp}/{snapshot.xp_needed}]",
+        )
 
-    @Logger.log_exception
-    async def currency_ticking(self):
+    async def task_sweeping(self):
+        """
+        Completes due user tasks in batches and notifies their owners
+        """
         while True:
-            await self.user_dao.currency_tick()
-            await asyncio.sleep(Settings.currency_tick_interval)
+            try:
+                completed = await self.user_task_dao.complete_due_tasks(
+                    Settings.task_sweep_batch
+                )
+            except Exception:
+                self.logger.exception("Task sweep failed")
+                completed = []
+            for task in completed:
+                try:
+                    await self.callback_for_completed_user_tasks(
+                        task.levels, task.telegram_id, task.task_id
+                    )
+                except Exception:
+                    self.logger.exception(
+                        f"Could not notify {task.telegram_id} about task {task.task_id}"
+                    )
+            if len(completed) < Settings.task_sweep_batch:
+                await asyncio.sleep(Settings.task_sweep_interval)
 
 
-async def main():
+async def create_game(index: int = 0, processes: int = 1) -> Game | None:
+    """
+    Checks the database and the task system, then creates the game with its own bot and dispatcher
+    :param index: number of the process, the first one is the leader
+    """
     check = await ConnectionManager().check_database()
     if not check:
         logger.fatal("Database is not initialized; Shutting down.")
-        return
+        return None
     logger.info("Database is initialized")
+    if await ConnectionManager().check_statements():
+        logger.fatal(
+            "SQL statements don't match the schema, run migrations; Shutting down."
+        )
+        return None
+    await UserDAO().set_accrual_interval()
     dp = Dispatcher()
-    Game(dp)
     bot = Bot(token=Settings.token, default=DefaultBotProperties())
+    bot.session.middleware(TelegramRequestMetrics())
+    game = Game(dp, bot, index == 0, processes)
     logger.info("TaskManager started")
-    tasks = TaskManager()
     try:
-        task = tasks.apply_with_delay(await_check_init)
+        task = game.task_manager.apply_with_delay(await_check_init)
         logger.info("Task system initialition checking...")
-        assert tasks.wait(task)
+        assert game.task_manager.wait(task)
     except Exception as e:
-        logger.fatal(f"Task system failed to initialize: {e}")
+        logger.critical(f"Task system failed to initialize: {e}", exc_info=True)
+        return None
+    if Settings.metrics_port:
+        start_metrics_server(Settings.metrics_port + index)
+    return game
+
+
+async def main():
+    game = await create_game()
+    if not game:
+        await ConnectionManager.close_pool()
         return
+    try:
+        if Settings.update_mode == "webhook":
+            logger.info("Serving webhook updates")
+            await run_webhook(game.dp, game.bot)
+        else:
+            await game.dp.start_polling(game.bot)
+    finally:
+        await ConnectionManager.close_pool()
 
-    await dp.start_polling(bot)
 
+logger = Logger("Main").get_logger()
 
 if __name__ == "__main__":
-    logger = Logger("Main").get_logger()
     logger.info("Starting bot")
-    asyncio.run(main())
+    if Settings.processes > 1:
+        run_supervisor()
+    else:
+        asyncio.run(main())
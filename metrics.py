@@ -0,0 +1,270 @@
+"""
+Module providing in-process metrics exposed in the Prometheus text format
+
+Metrics are plain in-memory counters updated on the hot path; they are rendered only when
+the endpoint started by start_metrics_server is scraped, from its own thread.
+"""
+
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from functools import lru_cache, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+
+from logger import Logger
+from settings import Settings
+
+# Latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def format_labels(names: tuple[str, ...], values: tuple[Any, ...]) -> str:
+    if not names:
+        return ""
+    pairs = (f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in list(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Gauge whose value is read from a function at scrape time
+    """
+
+    def __init__(self, name: str, help: str, function: Callable[[], float]) -> None:
+        self.name = name
+        self.help = help
+        self.function = function
+        REGISTRY.append(self)
+
+    def render(self) -> list[str]:
+        try:
+            value = self.function()
+        # A failing gauge must not break the whole scrape
+        except Exception:  # noqa: BLE001
+            return []
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {value}",
+        ]
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: observations per bucket (the last one is +Inf) and their sum
+        self.series: dict[tuple, tuple[list[int], list[float]]] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: Any) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), list(counts)):
+                cumulative += count
+                bucket_labels = format_labels((*self.labels, "le"), (*labels, bound))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            series_labels = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{series_labels} {total[0]}")
+            lines.append(f"{self.name}_count{series_labels} {cumulative}")
+        return lines
+
+
+REGISTRY: list[Counter | Gauge | Histogram] = []
+
+handler_seconds = Histogram(
+    "bot_handler_seconds", "Latency of bot update handlers", ("handler",)
+)
+handler_errors = Counter(
+    "bot_handler_errors_total", "Exceptions raised by bot update handlers", ("handler",)
+)
+query_seconds = Histogram(
+    "bot_db_query_seconds",
+    "Latency of SQL statements, by name for the named statements",
+    ("statement",),
+)
+query_errors = Counter(
+    "bot_db_query_errors_total", "Failed SQL statements", ("statement",)
+)
+statement_executions = Counter(
+    "bot_db_statement_executions_total",
+    "Executions of the named prepared statements",
+    ("statement",),
+)
+connections_opened = Counter(
+    "bot_db_connections_opened_total", "Connections opened by the pool"
+)
+pool_wait_seconds = Histogram(
+    "bot_db_pool_wait_seconds", "Time spent waiting for a pooled connection"
+)
+telegram_request_seconds = Histogram(
+    "bot_telegram_request_seconds", "Latency of Bot API calls", ("method",)
+)
+telegram_request_errors = Counter(
+    "bot_telegram_request_errors_total", "Failed Bot API calls", ("method", "error")
+)
+outbox_messages = Counter(
+    "bot_outbox_messages_total",
+    "Outgoing messages by outcome: sent, merged into a queued one, retried after flood control or failed",
+    ("outcome",),
+)
+currency_tick_seconds = Histogram(
+    "bot_currency_tick_seconds",
+    "Duration of global currency ticks",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300),
+)
+currency_tick_chunk_seconds = Histogram(
+    "bot_currency_tick_chunk_seconds", "Duration of currency tick chunks"
+)
+currency_tick_interval = Gauge(
+    "bot_currency_tick_interval_seconds",
+    "Configured interval of currency ticks, the tick should take well below it",
+    lambda: Settings.currency_tick_interval,
+)
+celery_task_seconds = Histogram(
+    "bot_celery_task_seconds", "Run time of celery tasks", ("task",)
+)
+celery_task_errors = Counter(
+    "bot_celery_task_errors_total", "Failed celery tasks", ("task",)
+)
+
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@lru_cache(maxsize=1024)
+def normalize_statement(query: str) -> str:
+    """
+    Collapses whitespace and literals of the statement, so it can be used as a label
+    """
+    query = re.sub(r"\s+", " ", query).strip()
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"\b\d+\b", "?", query)
+    return query[:200]
+
+
+def log_query(record) -> None:
+    """
+    asyncpg query logger recording latency of every statement
+    """
+    statement = normalize_statement(record.query)
+    query_seconds.observe(record.elapsed, statement)
+    if record.exception is not None:
+        query_errors.inc(statement)
+
+
+def track_handler(func):
+    """
+    Decorator recording latency and exceptions of a bot handler\n
+    Should be used to decorate an awaitable functions only, alongside Logger.log_exception
+    """
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+
+    return wrapper
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """
+    Bot session middleware recording latency and errors of every Bot API call
+    """
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            telegram_request_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - start, name)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def start_metrics_server(port: int | None) -> None:
+    """
+    Serves /metrics on the given port from a daemon thread, does nothing if the port is not set
+    """
+    if not port:
+        return
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsRequestHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    Logger("Metrics").get_logger().info(f"Serving metrics on port {port}")
@@ -4,22 +4,28 @@ from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 
 from logger import Logger
+from outbox import Outbox
+from users.user_cache import registered_users
 from users.user_repo import UserDAO
 
 
 class LoginMiddleware(BaseMiddleware):
     """
-    Middleware for checking user's registration, denies access to unregistered users sending them a login request
+    Middleware for checking user's registration, denies access to unregistered users sending them a login request\n
+    Registration status is cached in-process, so known users cost no database round trip.\n
+    Login requests are sent through the outbox, within the same rate limits as other messages
     """
 
-    def __init__(self, typ):
+    def __init__(self, typ, outbox: Outbox):
         """
         Create a new Login middleware
         :param typ: Type of the event (message, callback)
+        :param outbox: Outbox sending the login requests
         """
         self.logger = Logger(__class__.__name__).get_logger()
         self.user_dao = UserDAO()
         self.type = typ
+        self.outbox = outbox
         self.logger.info(f"Login middleware initialized: {self.type}")
 
     @Logger.log_exception
@@ -29,16 +35,22 @@ class LoginMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Coroutine[Any, Any, Any]:
-        if not await self.user_dao.check_user(event.from_user.id):
+        registered = registered_users.get(event.from_user.id)
+        if registered is None:
+            registered = await self.user_dao.check_user(event.from_user.id)
+            registered_users.set(event.from_user.id, registered)
+        if not registered:
             if self.type == "message":
-                await event.answer(
-                    "Для просмотра этого контента необходимо зарегистрироваться (/start)"
+                self.outbox.send(
+                    event.chat.id,
+                    "Для просмотра этого контента необходимо зарегистрироваться (/start)",
                 )
                 self.logger.warning(f"User {event.from_user.id} is not registered")
                 return  # type: ignore
             else:
-                await event.message.answer(
-                    "Для просмотра этого контента необходимо зарегистрироваться (/start)"
+                self.outbox.send(
+                    event.message.chat.id,
+                    "Для просмотра этого контента необходимо зарегистрироваться (/start)",
                 )
                 self.logger.warning(f"User {event.from_user.id} is not registered")
                 await event.answer()
@@ -0,0 +1,13 @@
+ALTER TABLE users ADD COLUMN last_accrued_at TIMESTAMPTZ NOT NULL DEFAULT now();
+ALTER TABLE users ADD COLUMN income BIGINT NOT NULL DEFAULT 0;
+
+UPDATE users u SET income = COALESCE(
+    (SELECT SUM(ub.count * b.income)
+     FROM users_buildings ub JOIN buildings b ON b.id = ub.building_id
+     WHERE ub.user_id = u.id), 0) * u.prestige;
+
+-- Number of whole currency ticks elapsed since accrued_at; 0 if tick_seconds is NULL
+CREATE OR REPLACE FUNCTION pending_ticks(accrued_at TIMESTAMPTZ, tick_seconds INTEGER)
+RETURNS BIGINT AS $$
+    SELECT COALESCE(floor(extract(epoch FROM now() - accrued_at) / tick_seconds)::BIGINT, 0)
+$$ LANGUAGE SQL STABLE;
@@ -0,0 +1,29 @@
+-- users.income is maintained by the application on purchases and prestige,
+-- catalog edits (e.g. from the admin panel) are propagated by the triggers below
+CREATE OR REPLACE FUNCTION buildings_income_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE users u SET income = u.income - OLD.income * ub.count * u.prestige
+        FROM users_buildings ub
+        WHERE ub.user_id = u.id AND ub.building_id = OLD.id;
+        RETURN OLD;
+    END IF;
+    UPDATE users u SET income = u.income + (NEW.income - OLD.income) * ub.count * u.prestige
+    FROM users_buildings ub
+    WHERE ub.user_id = u.id AND ub.building_id = NEW.id;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER buildings_income_update
+AFTER UPDATE OF income ON buildings
+FOR EACH ROW WHEN (OLD.income IS DISTINCT FROM NEW.income)
+EXECUTE FUNCTION buildings_income_changed();
+
+-- BEFORE, so that users_buildings rows are still there when the cascade runs
+CREATE TRIGGER buildings_income_delete
+BEFORE DELETE ON buildings
+FOR EACH ROW
+EXECUTE FUNCTION buildings_income_changed();
+
+CREATE INDEX users_with_income ON users (id) WHERE income > 0;
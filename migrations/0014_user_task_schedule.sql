@@ -0,0 +1,11 @@
+ALTER TABLE user_user_tasks ADD COLUMN started_at TIMESTAMPTZ NOT NULL DEFAULT now();
+-- Real start times of in-flight tasks are unknown, so they are treated as started now and end after
+-- their full length (in ticks of the default 60 seconds) instead of all becoming due at once
+ALTER TABLE user_user_tasks ADD COLUMN ends_at TIMESTAMPTZ;
+UPDATE user_user_tasks uut SET ends_at = uut.started_at + make_interval(secs => t.length * 60)
+FROM user_tasks t WHERE t.id = uut.task_id;
+ALTER TABLE user_user_tasks
+    ALTER COLUMN ends_at SET DEFAULT now(),
+    ALTER COLUMN ends_at SET NOT NULL;
+
+CREATE INDEX user_user_tasks_ends_at ON user_user_tasks (ends_at);
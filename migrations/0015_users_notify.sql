@@ -0,0 +1,16 @@
+-- Lets bot instances keep their registered users caches in sync
+CREATE OR REPLACE FUNCTION users_changed_notify() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('users_changed', 'delete:' || OLD.telegram_id);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('users_changed', 'insert:' || NEW.telegram_id);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_changed
+AFTER INSERT OR DELETE ON users
+FOR EACH ROW
+EXECUTE FUNCTION users_changed_notify();
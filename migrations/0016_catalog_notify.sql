@@ -0,0 +1,17 @@
+-- Lets bot instances invalidate their in-memory catalog on admin edits
+CREATE OR REPLACE FUNCTION catalog_changed_notify() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER buildings_catalog_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON buildings
+FOR EACH STATEMENT
+EXECUTE FUNCTION catalog_changed_notify();
+
+CREATE TRIGGER user_tasks_catalog_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON user_tasks
+FOR EACH STATEMENT
+EXECUTE FUNCTION catalog_changed_notify();
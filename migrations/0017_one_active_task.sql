@@ -0,0 +1,5 @@
+-- A user can have only one active task, lets start_task rely on the constraint instead of a racy check
+DELETE FROM user_user_tasks a USING user_user_tasks b
+WHERE a.user_id = b.user_id AND a.task_id > b.task_id;
+
+ALTER TABLE user_user_tasks ADD CONSTRAINT user_user_tasks_one_active UNIQUE (user_id);
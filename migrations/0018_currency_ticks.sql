@@ -0,0 +1,8 @@
+-- Time of the last global currency tick, written by the tick leader after every tick.
+-- A new leader pays the ticks missed since then.
+CREATE TABLE currency_ticks (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    last_tick TIMESTAMPTZ NOT NULL
+);
+
+INSERT INTO currency_ticks (last_tick) VALUES (now());
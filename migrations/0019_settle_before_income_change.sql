@@ -0,0 +1,28 @@
+-- Tick length of lazy income accrual, written by the bot on startup (NULL in global currency tick mode).
+-- Lets the triggers settle pending income before changing it, so the unsettled period isn't re-priced.
+ALTER TABLE currency_ticks ADD COLUMN accrual_seconds INTEGER DEFAULT 60;
+
+CREATE OR REPLACE FUNCTION buildings_income_changed() RETURNS TRIGGER AS $$
+DECLARE
+    tick INTEGER := (SELECT accrual_seconds FROM currency_ticks);
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE users u SET
+            currency = u.currency + u.income * pending_ticks(u.last_accrued_at, tick),
+            last_accrued_at = u.last_accrued_at
+                + make_interval(secs => pending_ticks(u.last_accrued_at, tick) * COALESCE(tick, 0)),
+            income = u.income - OLD.income * ub.count * u.prestige
+        FROM users_buildings ub
+        WHERE ub.user_id = u.id AND ub.building_id = OLD.id;
+        RETURN OLD;
+    END IF;
+    UPDATE users u SET
+        currency = u.currency + u.income * pending_ticks(u.last_accrued_at, tick),
+        last_accrued_at = u.last_accrued_at
+            + make_interval(secs => pending_ticks(u.last_accrued_at, tick) * COALESCE(tick, 0)),
+        income = u.income + (NEW.income - OLD.income) * ub.count * u.prestige
+    FROM users_buildings ub
+    WHERE ub.user_id = u.id AND ub.building_id = NEW.id;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
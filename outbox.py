@@ -0,0 +1,185 @@
+"""
+Module providing rate limited queue of outgoing telegram messages
+"""
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+from logger import Logger
+from metrics import outbox_messages
+from settings import Settings
+
+# Telegram rejects longer messages, merged texts must fit
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, refilled continuously with rate tokens per second up to capacity
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        Returns seconds to wait until a token is available
+        """
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """
+        Empties the bucket so that the next token is available in given seconds (used for retry_after)
+        """
+        self.refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutgoingMessage:
+    text: str
+    reply_markup: Any | None = None
+
+
+class Outbox:
+    """
+    Queue of outgoing messages, sent by background workers within Telegram limits.\n
+    Every chat and the bot as a whole have their own token buckets, retry_after responses postpone
+    only the affected chat. Consecutive texts queued for the same chat are merged into one message.\n
+    Handlers should call send, which enqueues the message and returns immediately.\n
+    Processes sharing the bot should split the global rate between them.
+    """
+
+    def __init__(self, bot: Bot, global_rate: float | None = None) -> None:
+        self.bot = bot
+        self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
+        self.pending: dict[int, deque[OutgoingMessage]] = {}
+        self.buckets: dict[int, TokenBucket] = {}
+        global_rate = global_rate or Settings.outbox_global_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.ready: asyncio.Queue[int] = asyncio.Queue()
+        self.scheduled: set[int] = set()
+        self.workers = [
+            asyncio.create_task(self.work()) for _ in range(Settings.outbox_workers)
+        ]
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of messages waiting to be sent
+        """
+        return sum(len(messages) for messages in self.pending.values())
+
+    def send(self, chat_id: int, text: str, reply_markup: Any | None = None) -> None:
+        """
+        Enqueues the message, merging it into the previous one queued for the chat if possible
+        """
+        messages = self.pending.setdefault(chat_id, deque())
+        last = messages[-1] if messages else None
+        if (
+            last
+            and last.reply_markup is None
+            and len(last.text) + len(text) + 1 <= MAX_MESSAGE_LENGTH
+        ):
+            last.text = f"{last.text}\n{text}"
+            last.reply_markup = reply_markup
+            outbox_messages.inc("merged")
+            return
+        messages.append(OutgoingMessage(text, reply_markup))
+        self.schedule(chat_id)
+
+    def schedule(self, chat_id: int, delay: float = 0) -> None:
+        """
+        Puts the chat to the ready queue (once), optionally after delay seconds
+        """
+        if chat_id in self.scheduled:
+            return
+        self.scheduled.add(chat_id)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, chat_id)
+        else:
+            self.ready.put_nowait(chat_id)
+
+    def bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) > Settings.outbox_max_buckets:
+                # Full buckets carry no state, forget them to bound memory
+                self.buckets = {
+                    chat: bucket
+                    for chat, bucket in self.buckets.items()
+                    if not bucket.is_full()
+                }
+            bucket = self.buckets[chat_id] = TokenBucket(
+                Settings.outbox_chat_rate, Settings.outbox_chat_burst
+            )
+        return bucket
+
+    async def work(self) -> None:
+        while True:
+            # The chat stays in scheduled while it's handled here,
+            # so no other worker sends to it concurrently and the order is kept
+            chat_id = await self.ready.get()
+            messages = self.pending.get(chat_id)
+            if not messages:
+                self.scheduled.discard(chat_id)
+                self.pending.pop(chat_id, None)
+                continue
+            bucket = self.bucket(chat_id)
+            delay = bucket.delay()
+            if delay > 0:
+                self.scheduled.discard(chat_id)
+                self.schedule(chat_id, delay)
+                continue
+            while (delay := self.global_bucket.delay()) > 0:
+                await asyncio.sleep(delay)
+            self.global_bucket.consume()
+            bucket.consume()
+            message = messages.popleft()
+            try:
+                await self.bot.send_message(
+                    chat_id, message.text, reply_markup=message.reply_markup
+                )
+                outbox_messages.inc("sent")
+            except TelegramRetryAfter as e:
+                self.logger.warning(
+                    f"Flood control for chat {chat_id}, retry after {e.retry_after}s"
+                )
+                outbox_messages.inc("retried")
+                messages.appendleft(message)
+                bucket.block(e.retry_after)
+            except TelegramAPIError as e:
+                self.logger.error(f"Could not send message to {chat_id}: {e}")
+                outbox_messages.inc("failed")
+            except Exception:
+                self.logger.exception(f"Could not send message to {chat_id}")
+                outbox_messages.inc("failed")
+            self.scheduled.discard(chat_id)
+            if messages:
+                self.schedule(chat_id, bucket.delay())
+            else:
+                self.pending.pop(chat_id, None)
@@ -1,4 +1,5 @@
 import os
+from typing import ClassVar
 
 import dotenv
 
@@ -13,6 +14,29 @@ def required_xp_formula(x):
     return 25 * x * x
 
 
+def required_xp_total_formula(x):
+    """Total experience needed to get from level 1 to level x, closed form of the sum of required_xp_formula"""
+    return 25 * (x - 1) * x * (2 * x - 1) // 6
+
+
+def check_xp_formulas(levels: int = 1000) -> None:
+    """
+    Checks that required_xp_total_formula is the sum of required_xp_formula, apply_xp relies on it.
+    Called on import, so editing only one of the formulas fails at startup.
+    """
+    total = 0
+    for level in range(1, levels):
+        if required_xp_total_formula(level) != total:
+            raise ValueError(
+                f"required_xp_total_formula({level}) = {required_xp_total_formula(level)}, "
+                f"but the levels of required_xp_formula before it sum up to {total}"
+            )
+        total += required_xp_formula(level)
+
+
+check_xp_formulas()
+
+
 class Settings:
     token = os.environ.get("TELEGRAMBOT_TOKEN")
     database_user = os.environ.get("TELEGRAMBOT_DB_USER")
@@ -20,11 +44,111 @@ class Settings:
     database_host = os.environ.get("TELEGRAMBOT_DB_HOST")
     database_port = os.environ.get("TELEGRAMBOT_DB_PORT")
     database_name = os.environ.get("TELEGRAMBOT_DB_NAME")
+    database_pool_min_size = int(os.environ.get("TELEGRAMBOT_DB_POOL_MIN_SIZE") or 2)
+    database_pool_max_size = int(os.environ.get("TELEGRAMBOT_DB_POOL_MAX_SIZE") or 10)
+    database_pool_max_queries = int(
+        os.environ.get("TELEGRAMBOT_DB_POOL_MAX_QUERIES") or 50000
+    )
+    database_pool_max_inactive_lifetime = float(
+        os.environ.get("TELEGRAMBOT_DB_POOL_MAX_INACTIVE_LIFETIME") or 300
+    )
+    database_pool_acquire_timeout = float(
+        os.environ.get("TELEGRAMBOT_DB_POOL_ACQUIRE_TIMEOUT") or 10
+    )
+    database_pool_health_check = (
+        os.environ.get("TELEGRAMBOT_DB_POOL_HEALTH_CHECK", "false").lower() == "true"
+    )
     log_dir = os.environ.get("TELEGRAMBOT_LOG_DIR")
+    log_level = (os.environ.get("TELEGRAMBOT_LOG_LEVEL") or "DEBUG").upper()
+    # Per logger overrides, e.g. "UserDAO=WARNING,Outbox=DEBUG"
+    log_levels: ClassVar[dict[str, str]] = {
+        name.strip(): level.strip().upper()
+        for name, _, level in (
+            item.partition("=")
+            for item in (os.environ.get("TELEGRAMBOT_LOG_LEVELS") or "").split(",")
+            if "=" in item
+        )
+    }
+    # Only every n-th hot path record is logged
+    log_sample_every = int(os.environ.get("TELEGRAMBOT_LOG_SAMPLE_EVERY") or 1)
+    # Log file is rotated by size if set, otherwise every midnight
+    log_max_bytes = int(os.environ.get("TELEGRAMBOT_LOG_MAX_BYTES") or 0)
+    log_backup_count = int(os.environ.get("TELEGRAMBOT_LOG_BACKUP_COUNT") or 14)
     currency_tick_interval = int(
         os.environ.get("TELEGRAMBOT_CURRENCY_TICK_INTERVAL") or 60
     )
+    # Users paid per transaction by the global currency tick
+    currency_tick_chunk_size = int(
+        os.environ.get("TELEGRAMBOT_CURRENCY_TICK_CHUNK_SIZE") or 10000
+    )
+    # "lazy" settles income on access, "tick" pays everyone on a global currency tick
+    currency_accrual = os.environ.get("TELEGRAMBOT_CURRENCY_ACCRUAL") or "lazy"
+    # "postgres" completes user tasks with a batch sweep, "celery" uses countdown messages
+    user_task_scheduler = (
+        os.environ.get("TELEGRAMBOT_USER_TASK_SCHEDULER") or "postgres"
+    )
+    task_sweep_interval = float(os.environ.get("TELEGRAMBOT_TASK_SWEEP_INTERVAL") or 1)
+    task_sweep_batch = int(os.environ.get("TELEGRAMBOT_TASK_SWEEP_BATCH") or 500)
+    # Threads of the celery worker pool (celery_start.sh), each one waits for its completion,
+    # so a batch never holds more completions than there are threads
+    worker_concurrency = int(os.environ.get("TELEGRAMBOT_WORKER_CONCURRENCY") or 8)
+    worker_batch_size = min(
+        int(os.environ.get("TELEGRAMBOT_WORKER_BATCH_SIZE") or worker_concurrency),
+        worker_concurrency,
+    )
+    worker_batch_window = float(
+        os.environ.get("TELEGRAMBOT_WORKER_BATCH_WINDOW") or 0.05
+    )
+    user_cache_size = int(os.environ.get("TELEGRAMBOT_USER_CACHE_SIZE") or 100000)
+    user_cache_negative_ttl = float(
+        os.environ.get("TELEGRAMBOT_USER_CACHE_NEGATIVE_TTL") or 5
+    )
+    catalog_page_size = int(os.environ.get("TELEGRAMBOT_CATALOG_PAGE_SIZE") or 5)
+    # Telegram allows about 30 messages per second overall and about one per second per chat
+    outbox_global_rate = float(os.environ.get("TELEGRAMBOT_OUTBOX_GLOBAL_RATE") or 30)
+    outbox_chat_rate = float(os.environ.get("TELEGRAMBOT_OUTBOX_CHAT_RATE") or 1)
+    outbox_chat_burst = float(os.environ.get("TELEGRAMBOT_OUTBOX_CHAT_BURST") or 3)
+    outbox_workers = int(os.environ.get("TELEGRAMBOT_OUTBOX_WORKERS") or 8)
+    outbox_max_buckets = int(os.environ.get("TELEGRAMBOT_OUTBOX_MAX_BUCKETS") or 10000)
+    # "polling" or "webhook", replicas behind webhook.py ingress must use "webhook"
+    update_mode = os.environ.get("TELEGRAMBOT_UPDATE_MODE") or "polling"
+    webhook_host = os.environ.get("TELEGRAMBOT_WEBHOOK_HOST") or "0.0.0.0"
+    webhook_port = int(os.environ.get("TELEGRAMBOT_WEBHOOK_PORT") or 8080)
+    webhook_path = os.environ.get("TELEGRAMBOT_WEBHOOK_PATH") or "/webhook"
+    # Public base url registered with set_webhook, left empty for replicas behind the ingress
+    webhook_url = os.environ.get("TELEGRAMBOT_WEBHOOK_URL")
+    webhook_secret = os.environ.get("TELEGRAMBOT_WEBHOOK_SECRET")
+    webhook_max_connections = int(
+        os.environ.get("TELEGRAMBOT_WEBHOOK_MAX_CONNECTIONS") or 40
+    )
+    webhook_replicas: ClassVar[list[str]] = [
+        replica.strip()
+        for replica in (os.environ.get("TELEGRAMBOT_WEBHOOK_REPLICAS") or "").split(",")
+        if replica.strip()
+    ]
+    # Number of bot processes, updates are sharded between them by user id
+    processes = int(os.environ.get("TELEGRAMBOT_PROCESSES") or 1)
+    # Updates queued for each worker and handled by it at once, the receiver waits beyond that
+    supervisor_queue_size = int(
+        os.environ.get("TELEGRAMBOT_SUPERVISOR_QUEUE_SIZE") or 1000
+    )
+    # Port of the /metrics endpoint (the n-th supervised process uses port + n), disabled if not set
+    metrics_port = int(os.environ.get("TELEGRAMBOT_METRICS_PORT") or 0)
+    celery_metrics_port = int(os.environ.get("TELEGRAMBOT_CELERY_METRICS_PORT") or 0)
     prestige_formula = prestige_formula
     required_xp_formula = required_xp_formula
+    required_xp_total_formula = required_xp_total_formula
     broker = os.environ.get("TELEGRAMBOT_BROKER")
     backend = os.environ.get("TELEGRAMBOT_BROKER_BACKEND")
+    # Redis holding the leaderboards, the result backend is used if not set; leaderboards are disabled without redis
+    leaderboard_redis = os.environ.get("TELEGRAMBOT_LEADERBOARD_REDIS") or (
+        backend if backend and backend.startswith("redis") else None
+    )
+    leaderboard_size = int(os.environ.get("TELEGRAMBOT_LEADERBOARD_SIZE") or 10)
+    # Seconds between rebuilds of the leaderboards from the database, and users read per query while rebuilding
+    leaderboard_reconcile_interval = int(
+        os.environ.get("TELEGRAMBOT_LEADERBOARD_RECONCILE_INTERVAL") or 600
+    )
+    leaderboard_chunk_size = int(
+        os.environ.get("TELEGRAMBOT_LEADERBOARD_CHUNK_SIZE") or 10000
+    )
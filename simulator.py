@@ -0,0 +1,406 @@
+"""
+Offline economy simulator for balancing the catalog and the game formulas
+
+Usage:
+    python simulator.py [players] [days] [processes] [--database]
+
+Simulates players with randomly drawn strategies: how often they play, how much of their money they spend
+on buildings (most expensive affordable first), whether they run tasks (best reward per minute available)
+and how far above its price they buy prestige. Players are numpy arrays, so a million players are simulated
+at once. The catalog is read from the INSERTs of the migrations, or with --database from the configured database;
+Settings.prestige_formula, Settings.required_xp_total_formula and currency rewards of REWARD_DICT are the live ones.
+
+Players are split between processes (all CPUs by default), which report histograms that are added up,
+so currency percentiles are accurate to a tenth of an order of magnitude and times to an hour.
+Reports currency inflation per day and distributions of time to reach levels and prestiges.
+Requires numpy (pip install numpy), which the bot itself doesn't use.
+"""
+
+import ast
+import asyncio
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+from settings import Settings
+from users.level_rewards import REWARD_DICT
+
+# Hours per simulation step, players act at most once per step
+STEP_HOURS = 1
+# Hours between sessions of a player and their shares among players
+SESSION_HOURS = (1, 3, 6, 12, 24)
+SESSION_SHARES = (0.05, 0.15, 0.3, 0.3, 0.2)
+# Buy prestige once currency reaches its price times the margin, players never prestiging have inf
+PRESTIGE_MARGINS = (1.0, 1.5, 3.0, np.inf)
+# Share of players running tasks
+TASK_SHARE = 0.7
+# Milestones of the time to level and time to prestige reports
+LEVELS = (5, 10, 15, 20, 30, 50)
+PRESTIGES = (2, 3, 4, 5)
+MAX_LEVEL = 10_000
+# Largest value of the BIGINT columns, the game fails to store anything above it
+BIGINT = 2**63 - 1
+# Histogram bins of currency and income, by tenths of an order of magnitude up to BIGINT
+CURRENCY_BINS = np.linspace(0, 19, 191)
+
+INSERT_RE = re.compile(
+    r"INSERT INTO (buildings|user_tasks)\s*\(([^)]*)\)\s*VALUES\s*(.*?)(?:;|$)",
+    re.DOTALL | re.IGNORECASE,
+)
+ROW_RE = re.compile(r"\(((?:'(?:[^']|'')*'|[^'()])*)\)")
+
+
+def load_migrations_catalog() -> tuple[list[dict], list[dict]]:
+    """
+    Replays the INSERTs of buildings and user_tasks found in the migrations (later edits are not applied)
+    """
+    tables: dict[str, list[dict]] = {"buildings": [], "user_tasks": []}
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+    for file in sorted(os.listdir(directory)):
+        if not file.endswith(".sql"):
+            continue
+        with open(os.path.join(directory, file), "r") as migration:
+            text = migration.read()
+        for table, columns, values in INSERT_RE.findall(text):
+            names = [column.strip() for column in columns.split(",")]
+            for row in ROW_RE.findall(values):
+                tables[table].append(dict(zip(names, ast.literal_eval(f"({row},)"))))
+    return tables["buildings"], tables["user_tasks"]
+
+
+async def load_database_catalog() -> tuple[list[dict], list[dict]]:
+    from catalog import catalog
+    from database import ConnectionManager
+
+    try:
+        buildings = await catalog.get_buildings(1)
+        tasks = await catalog.get_tasks(1)
+    finally:
+        await ConnectionManager.close_pool()
+    return [building.model_dump() for building in buildings], [
+        task.model_dump() for task in tasks
+    ]
+
+
+class Economy:
+    """
+    State of every simulated player, one array element per player.\n
+    Players are ordered by their session length and phase, so the players acting in a step are a few
+    contiguous slices and every step works on array views. Income is settled lazily, like in the game:
+    only acting players are touched, and their tasks are completed when they come back.
+    """
+
+    def __init__(
+        self, players: int, buildings: list[dict], tasks: list[dict], seed: int = 0
+    ) -> None:
+        rng = np.random.default_rng(seed)
+        # Ticks of income per step
+        self.ticks = STEP_HOURS * 3600 / Settings.currency_tick_interval
+
+        buildings = sorted(buildings, key=lambda building: -building["cost"])
+        self.building_cost = np.array([b["cost"] for b in buildings], dtype=np.float64)
+        self.building_income = np.array(
+            [b["income"] for b in buildings], dtype=np.float64
+        )
+        # Rewards have a trailing zero for players without a task (-1)
+        self.task_reward = np.array([t["reward"] for t in tasks] + [0], np.float64)
+        self.task_xp = np.array([t["exp_reward"] for t in tasks] + [0], np.float64)
+        self.task_cost = np.array([t["cost"] for t in tasks], dtype=np.float64)
+        self.task_level = np.array([t["lvl_required"] for t in tasks])
+        self.task_steps = np.array([t["length"] for t in tasks]) / self.ticks
+
+        levels = np.arange(1, MAX_LEVEL + 1, dtype=np.int64)
+        # Total experience of every level (index 0 is level 1, inf past MAX_LEVEL)
+        # and currency rewarded up to every level
+        self.level_xp = np.append(
+            Settings.required_xp_total_formula(levels).astype(np.float64), np.inf
+        )
+        rewards = np.zeros(MAX_LEVEL + 1)
+        for level, reward in REWARD_DICT.items():
+            if 1 < level <= MAX_LEVEL and reward.to_currency() is not None:
+                rewards[level] = reward.to_currency()
+        self.level_rewards = np.cumsum(rewards)
+        # Task with the best reward per tick available on every level, -1 if there is none
+        self.best_task = np.full(MAX_LEVEL + 1, -1)
+        for task in sorted(
+            range(len(tasks)),
+            key=lambda task: tasks[task]["reward"] / tasks[task]["length"],
+        ):
+            self.best_task[self.task_level[task] :] = task
+
+        every = rng.choice(
+            [hours // STEP_HOURS for hours in SESSION_HOURS], players, p=SESSION_SHARES
+        )
+        phase = rng.integers(0, every)
+        order = np.lexsort((phase, every))
+        every, phase = every[order], phase[order]
+        # Slices of the players acting on every phase of every session length
+        self.sessions: dict[int, list[slice]] = {}
+        for period in np.unique(every):
+            group = np.flatnonzero(every == period)
+            bounds = group[0] + np.searchsorted(
+                phase[group], np.arange(period + 1), "left"
+            )
+            self.sessions[int(period)] = [
+                slice(bounds[offset], bounds[offset + 1]) for offset in range(period)
+            ]
+
+        self.currency = np.full(players, 1500, dtype=np.float64)
+        self.income = np.zeros(players)
+        self.settled = np.zeros(players)
+        self.prestige = np.ones(players)
+        self.level = np.ones(players, dtype=np.int64)
+        self.xp = np.zeros(players)
+        self.task = np.full(players, -1, dtype=np.int64)
+        self.task_ends = np.zeros(players)
+
+        self.spend = rng.uniform(0.3, 1.0, players)
+        self.does_tasks = rng.random(players) < TASK_SHARE
+        self.margin = rng.choice(PRESTIGE_MARGINS, players)
+
+        # Hours when every player first reached the milestones, one row per milestone
+        self.level_reached_at = np.full((len(LEVELS), players), np.nan, np.float32)
+        self.prestige_reached_at = np.full(
+            (len(PRESTIGES), players), np.nan, np.float32
+        )
+
+    def step(self, step: int) -> None:
+        for period, slices in self.sessions.items():
+            players = slices[step % period]
+            currency = self.currency[players]
+            currency += (
+                self.income[players] * (step - self.settled[players]) * self.ticks
+            )
+            np.minimum(currency, BIGINT, out=currency)
+            self.settled[players] = step
+            self.complete_tasks(players, step)
+            self.buy_prestige(players, step)
+            self.start_tasks(players, step)
+            self.buy_buildings(players)
+
+    def complete_tasks(self, players: slice, step: int) -> None:
+        task = self.task[players]
+        # Dense over the acting players: task -1 picks the trailing zero reward
+        finished = np.where(self.task_ends[players] <= step, task, -1)
+        prestige = self.prestige[players]
+        self.currency[players] += self.task_reward[finished] * prestige
+        xp = self.xp[players]
+        xp += self.task_xp[finished] * prestige
+        np.copyto(task, -1, where=finished >= 0)
+        level = self.level[players]
+        # level_xp[level] is the experience of the next level
+        leveled = np.flatnonzero(xp >= self.level_xp[level])
+        if not len(leveled):
+            return
+        was = level[leveled]
+        gained = xp[leveled]
+        # A task rarely gives more than a few levels, so levels are counted up instead of searched for
+        reached = was + 1
+        more = np.flatnonzero(gained >= self.level_xp[reached])
+        while len(more):
+            reached[more] += 1
+            more = more[gained[more] >= self.level_xp[reached[more]]]
+        level[leveled] = reached
+        self.currency[players][leveled] += (
+            self.level_rewards[reached] - self.level_rewards[was]
+        )
+        ends = self.task_ends[players][leveled] * STEP_HOURS
+        for reached_at, milestone in zip(self.level_reached_at, LEVELS):
+            crossed = np.flatnonzero((was < milestone) & (reached >= milestone))
+            first = leveled[crossed]
+            reached_at = reached_at[players]
+            reached_at[first] = np.fmin(reached_at[first], ends[crossed])
+
+    def buy_prestige(self, players: slice, step: int) -> None:
+        prestige = self.prestige[players]
+        price = Settings.prestige_formula(prestige)
+        bought = np.flatnonzero(self.currency[players] >= price * self.margin[players])
+        if not len(bought):
+            return
+        prestige[bought] += 1
+        self.currency[players][bought] = 1000 * prestige[bought]
+        self.income[players][bought] = 0
+        self.level[players][bought] = 1
+        self.xp[players][bought] = 0
+        for reached_at, milestone in zip(self.prestige_reached_at, PRESTIGES):
+            reached_at = reached_at[players]
+            first = bought[prestige[bought] == milestone]
+            reached_at[first] = np.fmin(reached_at[first], step * STEP_HOURS)
+
+    def start_tasks(self, players: slice, step: int) -> None:
+        task = self.task[players]
+        currency = self.currency[players]
+        best = self.best_task[self.level[players]]
+        idle = np.flatnonzero(
+            self.does_tasks[players]
+            & (task < 0)
+            & (best >= 0)
+            & (self.task_cost[best] <= currency)
+        )
+        best = best[idle]
+        currency[idle] -= self.task_cost[best]
+        task[idle] = best
+        self.task_ends[players][idle] = step + self.task_steps[best]
+
+    def buy_buildings(self, players: slice) -> None:
+        """
+        Buys the most expensive affordable building as many times as possible, then the next one
+        """
+        currency = self.currency[players]
+        budget = currency * self.spend[players]
+        richest = budget.max(initial=0)
+        count = np.empty_like(budget)
+        bought = np.empty_like(budget)
+        income = np.zeros_like(budget)
+        for cost, building_income in zip(self.building_cost, self.building_income):
+            if cost > richest:
+                continue
+            np.divide(budget, cost, out=count)
+            np.floor(count, out=count)
+            np.multiply(count, cost, out=bought)
+            budget -= bought
+            currency -= bought
+            np.multiply(count, building_income, out=bought)
+            income += bought
+        income *= self.prestige[players]
+        self.income[players] += income
+
+    def snapshot(self, step: int) -> dict[str, np.ndarray | float]:
+        """
+        Statistics of the day, as sums and histograms so that those of several processes can be added up
+        """
+        currency = np.minimum(
+            self.currency + self.income * (step - self.settled) * self.ticks, BIGINT
+        )
+        return {
+            "currency": log_histogram(currency),
+            "income": log_histogram(self.income),
+            "money_supply": float(currency.sum()),
+            "level": float(self.level.sum()),
+            "prestige": float(self.prestige.sum()),
+            "overflow": float((currency >= BIGINT).sum()),
+        }
+
+    @staticmethod
+    def reached(reached_at: np.ndarray, days: int) -> np.ndarray:
+        """
+        Histograms of hours when the milestones were reached, the last bin counts players who never did
+        """
+        hours = np.nan_to_num(reached_at, nan=days * 24 + 1).astype(np.int64)
+        return np.stack([np.bincount(row, minlength=days * 24 + 2) for row in hours])
+
+
+def log_histogram(values: np.ndarray) -> np.ndarray:
+    return np.histogram(np.log10(values + 1), CURRENCY_BINS)[0]
+
+
+def percentile(histogram: np.ndarray, q: float) -> int:
+    """
+    Index of the bin holding the q-th percentile of the histogram
+    """
+    cumulative = np.cumsum(histogram)
+    return int(np.searchsorted(cumulative, cumulative[-1] * q / 100))
+
+
+def simulate(
+    players: int, days: int, buildings: list[dict], tasks: list[dict], seed: int
+) -> dict:
+    """
+    Simulates the players, runs in a worker process
+    """
+    economy = Economy(players, buildings, tasks, seed)
+    steps_per_day = 24 // STEP_HOURS
+    daily = []
+    for step in range(1, days * steps_per_day + 1):
+        economy.step(step)
+        if step % steps_per_day == 0:
+            daily.append(economy.snapshot(step))
+    return {
+        "daily": daily,
+        "levels": economy.reached(economy.level_reached_at, days),
+        "prestiges": economy.reached(economy.prestige_reached_at, days),
+    }
+
+
+def merge(results: list[dict]) -> dict:
+    merged = results[0]
+    for result in results[1:]:
+        for day, values in zip(merged["daily"], result["daily"]):
+            for name, value in values.items():
+                day[name] = day[name] + value
+        merged["levels"] = merged["levels"] + result["levels"]
+        merged["prestiges"] = merged["prestiges"] + result["prestiges"]
+    return merged
+
+
+def distribution(histogram: np.ndarray) -> str:
+    """
+    Share of players who reached the milestone and percentiles of the hours it took
+    """
+    reached = histogram[:-1]
+    share = reached.sum() / histogram.sum() * 100
+    if not reached.sum():
+        return f"{share:6.1f}%"
+    p10, p50, p90 = (percentile(reached, q) for q in (10, 50, 90))
+    return f"{share:6.1f}%  p10 {p10:5}h  p50 {p50:5}h  p90 {p90:5}h"
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    players = int(args[0]) if len(args) > 0 else 1_000_000
+    days = int(args[1]) if len(args) > 1 else 30
+    processes = int(args[2]) if len(args) > 2 else os.cpu_count() or 1
+    if "--database" in sys.argv:
+        buildings, tasks = asyncio.run(load_database_catalog())
+    else:
+        buildings, tasks = load_migrations_catalog()
+    print(f"Catalog: {len(buildings)} buildings, {len(tasks)} tasks")
+
+    start = time.perf_counter()
+    chunks = [
+        (
+            players // processes + (index < players % processes),
+            days,
+            buildings,
+            tasks,
+            index,
+        )
+        for index in range(processes)
+    ]
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        result = merge(pool.starmap(simulate, chunks))
+    print(
+        f"Simulated {players} players for {days} days in {time.perf_counter() - start:.1f}s "
+        f"({processes} processes)"
+    )
+
+    print(
+        "Day  median currency     p99 currency     money supply  median income  level  prestige  overflow"
+    )
+    previous = None
+    for day, values in enumerate(result["daily"], 1):
+        growth = f"  (+{values['money_supply'] / previous - 1:.0%})" if previous else ""
+        previous = values["money_supply"]
+        median, p99 = (
+            10 ** CURRENCY_BINS[percentile(values["currency"], q)] for q in (50, 99)
+        )
+        income = 10 ** CURRENCY_BINS[percentile(values["income"], 50)]
+        print(
+            f"{day:3}  {median:15.3g}  {p99:15.3g}  {values['money_supply']:15.3g}  {income:13.3g}  "
+            f"{values['level'] / players:5.1f}  {values['prestige'] / players:8.2f}  "
+            f"{values['overflow'] / players:8.2%}{growth}"
+        )
+    print("Time to level:")
+    for level, histogram in zip(LEVELS, result["levels"]):
+        print(f"  {level:3}  {distribution(histogram)}")
+    print("Time to prestige:")
+    for prestige, histogram in zip(PRESTIGES, result["prestiges"]):
+        print(f"  {prestige:3}  {distribution(histogram)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Registry of the named SQL statements used by the DAOs
+
+Every pooled connection prepares all of them once when it is opened, DAOs execute them by name
+(see StatementConnection in database.py). Statements are checked against the current schema on startup
+and by "python tables.py check_statements".
+"""
+
+# Users whose stored income differs from the one derived from their buildings
+INCOME_DRIFT_SQL = """SELECT u.id, u.telegram_id, u.income AS stored,
+    COALESCE(SUM(ub.count * b.income), 0) * u.prestige AS actual
+FROM users u
+LEFT JOIN users_buildings ub ON ub.user_id = u.id
+LEFT JOIN buildings b ON b.id = ub.building_id
+GROUP BY u.id
+HAVING u.income <> COALESCE(SUM(ub.count * b.income), 0) * u.prestige"""
+
+# Settles the income accrued since users.last_accrued_at for user $1, whole ticks of $2 seconds only.
+# Passing NULL as $2 disables settlement (global currency tick mode).
+SETTLE_CTE = """settled AS (
+    UPDATE users SET
+        currency = currency + income * pending_ticks(last_accrued_at, $2),
+        last_accrued_at = last_accrued_at + make_interval(secs => pending_ticks(last_accrued_at, $2) * $2)
+    WHERE telegram_id = $1 AND pending_ticks(last_accrued_at, $2) > 0
+    RETURNING currency
+)"""
+
+# Rewards tasks removed by the preceding "done" CTE and returns their owners
+REWARD_DONE_SQL = """UPDATE users u SET
+    currency = u.currency + t.reward * u.prestige,
+    xp = u.xp + t.exp_reward * u.prestige
+FROM done JOIN user_tasks t ON t.id = done.task_id
+WHERE u.id = done.user_id
+RETURNING u.telegram_id, done.task_id, u.lvl, u.xp"""
+
+STATEMENTS: dict[str, str] = {
+    # UserDAO
+    "users.update_currency": "UPDATE users SET currency = currency + $1 WHERE telegram_id = $2 RETURNING currency",
+    "users.get_level": "SELECT lvl, xp FROM users WHERE telegram_id = $1",
+    "users.prestige_up": """WITH up AS (
+        UPDATE users SET
+            prestige = prestige + 1, lvl = 1, xp = 0, income = 0,
+            currency = 1000 * (prestige + 1), last_accrued_at = now()
+        WHERE telegram_id = $1 AND prestige = $3
+            AND currency + income * pending_ticks(last_accrued_at, $2) >= $4
+        RETURNING id, currency, income, prestige
+    ), wiped AS (
+        DELETE FROM users_buildings WHERE user_id IN (SELECT id FROM up)
+    )
+    SELECT currency, income, prestige FROM up""",
+    "users.register": "INSERT INTO users (telegram_id) VALUES ($1) RETURNING currency, income, prestige, lvl",
+    "users.check": "SELECT 1 FROM users WHERE telegram_id = $1",
+    "users.buy_building": """WITH b AS (
+        SELECT cost, income FROM buildings WHERE id = $2
+    ), bought AS (
+        UPDATE users u SET
+            currency = u.currency + u.income * pending_ticks(u.last_accrued_at, $3) - b.cost,
+            last_accrued_at = u.last_accrued_at
+                + make_interval(secs => pending_ticks(u.last_accrued_at, $3) * COALESCE($3, 0)),
+            income = u.income + b.income * u.prestige
+        FROM b
+        WHERE u.telegram_id = $1
+            AND u.currency + u.income * pending_ticks(u.last_accrued_at, $3) >= b.cost
+        RETURNING u.id, u.currency, u.income
+    ), owned AS (
+        INSERT INTO users_buildings (user_id, building_id, count)
+        SELECT id, $2, 1 FROM bought
+        ON CONFLICT (user_id, building_id) DO UPDATE SET count = users_buildings.count + 1
+    )
+    SELECT currency, income FROM bought""",
+    "users.get_last_currency_tick": "SELECT last_tick FROM currency_ticks",
+    "users.set_last_currency_tick": "UPDATE currency_ticks SET last_tick = $1",
+    "users.set_accrual_interval": "UPDATE currency_ticks SET accrual_seconds = $1",
+    "users.get_max_id": "SELECT COALESCE(max(id), 0) FROM users",
+    "users.currency_tick": """UPDATE users SET
+        currency = currency + income * LEAST(
+            $4, ceil(extract(epoch FROM $3 - last_accrued_at) / $5)::BIGINT
+        ),
+        last_accrued_at = $3
+    WHERE id >= $1 AND id < $2 AND income > 0 AND last_accrued_at < $3""",
+    "users.get_currency": f"""WITH {SETTLE_CTE}
+    SELECT COALESCE((SELECT currency FROM settled),
+                    (SELECT currency FROM users WHERE telegram_id = $1))""",
+    "users.get_income": "SELECT income FROM users WHERE telegram_id = $1",
+    "users.find_income_drift": INCOME_DRIFT_SQL,
+    # Settles pending income at the old rate before changing it, SET expressions all read the old row
+    "users.repair_income_drift": f"""UPDATE users SET
+        currency = currency + income * pending_ticks(last_accrued_at, $1),
+        last_accrued_at = last_accrued_at
+            + make_interval(secs => pending_ticks(last_accrued_at, $1) * COALESCE($1, 0)),
+        income = drift.actual
+    FROM ({INCOME_DRIFT_SQL}) drift
+    WHERE users.id = drift.id
+    RETURNING users.id""",
+    "users.get_player_snapshot": f"""WITH {SETTLE_CTE}
+    SELECT COALESCE((SELECT currency FROM settled), u.currency) AS currency,
+        u.income, u.lvl, u.xp, u.prestige,
+        (SELECT task_id FROM user_user_tasks WHERE user_id = u.id LIMIT 1) AS active_task_id,
+        ARRAY(SELECT building_id FROM users_buildings WHERE user_id = u.id ORDER BY building_id) AS building_ids,
+        ARRAY(SELECT count FROM users_buildings WHERE user_id = u.id ORDER BY building_id) AS building_counts
+    FROM users u WHERE u.telegram_id = $1""",
+    "users.get_prestige": "SELECT prestige FROM users WHERE telegram_id = $1",
+    "users.add_xp": "UPDATE users SET xp = xp + $2 WHERE telegram_id = $1 RETURNING telegram_id, lvl, xp",
+    "users.apply_levels": """UPDATE users u SET lvl = c.lvl, xp = c.xp, currency = u.currency + c.currency
+    FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[]) AS c(telegram_id, lvl, xp, currency)
+    WHERE u.telegram_id = c.telegram_id
+    RETURNING u.telegram_id, u.currency, u.lvl""",
+    # UserTaskDAO
+    "tasks.complete": f"""WITH requested AS (
+        SELECT * FROM unnest($1::bigint[], $2::int[]) AS r(telegram_id, task_id)
+    ), done AS (
+        DELETE FROM user_user_tasks uut USING requested r, users ru
+        WHERE ru.telegram_id = r.telegram_id AND uut.user_id = ru.id AND uut.task_id = r.task_id
+        RETURNING uut.user_id, uut.task_id
+    )
+    {REWARD_DONE_SQL}""",
+    "tasks.get_active": "SELECT task_id FROM user_user_tasks WHERE user_id = (SELECT id FROM users WHERE telegram_id = $1)",
+    "tasks.start": """WITH u AS (
+        SELECT id, lvl, prestige,
+            currency + income * pending_ticks(last_accrued_at, $3) AS currency
+        FROM users WHERE telegram_id = $1
+        FOR UPDATE
+    ), t AS (
+        SELECT id, cost, lvl_required, length FROM user_tasks WHERE id = $2
+    ), active AS (
+        SELECT task_id FROM user_user_tasks WHERE user_id = (SELECT id FROM u)
+    ), status AS (
+        SELECT CASE
+            WHEN EXISTS (SELECT 1 FROM active) THEN 3
+            WHEN u.currency < t.cost THEN 2
+            WHEN u.lvl < t.lvl_required THEN 1
+            ELSE 0
+        END AS code
+        FROM u, t
+    ), started AS (
+        INSERT INTO user_user_tasks (user_id, task_id, started_at, ends_at)
+        SELECT u.id, t.id, now(), now() + make_interval(secs => t.length * $4)
+        FROM u, t, status WHERE status.code = 0
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING user_id
+    ), debited AS (
+        UPDATE users SET
+            currency = currency + income * pending_ticks(last_accrued_at, $3) - (SELECT cost FROM t),
+            last_accrued_at = last_accrued_at
+                + make_interval(secs => pending_ticks(last_accrued_at, $3) * COALESCE($3, 0))
+        WHERE id IN (SELECT user_id FROM started)
+    )
+    SELECT
+        CASE WHEN status.code = 0 AND NOT EXISTS (SELECT 1 FROM started) THEN 3
+        ELSE status.code END AS status,
+        (SELECT task_id FROM active) AS active_task_id,
+        u.prestige
+    FROM status, u""",
+    "tasks.complete_due": f"""WITH due AS (
+        SELECT user_id, task_id FROM user_user_tasks
+        WHERE ends_at <= now()
+        ORDER BY ends_at
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ), done AS (
+        DELETE FROM user_user_tasks uut USING due
+        WHERE uut.user_id = due.user_id AND uut.task_id = due.task_id
+        RETURNING uut.user_id, uut.task_id
+    )
+    {REWARD_DONE_SQL}""",
+    # Catalog of BuildingDAO and UserTaskDAO
+    "catalog.buildings": "SELECT id, cost, name, income FROM buildings ORDER BY id",
+    "catalog.tasks": "SELECT id, name, reward, exp_reward, lvl_required, cost, length FROM user_tasks ORDER BY id",
+    # Leaderboard reconciliation
+    "leaderboard.scores": """SELECT id, telegram_id,
+        currency + income * pending_ticks(last_accrued_at, $3) AS currency,
+        income, prestige, lvl
+    FROM users WHERE id > $1 ORDER BY id LIMIT $2""",
+    # MigrationManager
+    "migrations.applied": "SELECT filename, checksum FROM migrations",
+    "migrations.record": "INSERT INTO migrations (filename, checksum) VALUES ($1, $2)",
+    "migrations.set_checksum": "UPDATE migrations SET checksum = $2 WHERE filename = $1",
+}
@@ -0,0 +1,212 @@
+"""
+Supervisor running the bot in several processes
+
+Started by main.py when TELEGRAMBOT_PROCESSES is greater than 1. Only the supervisor receives updates
+(by long polling or webhook, see TELEGRAMBOT_UPDATE_MODE) and shards them by the sending user id between
+worker processes, each running its own Game. Updates of one user always reach the same worker and are
+handled there in order, so per-user in-memory state needs no coordination between processes.
+Worker 0 is the leader running the singleton duties; a worker that dies is restarted with the same shard.
+"""
+
+import asyncio
+import multiprocessing
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from typing import Any
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import PRODUCTION
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+from database import ConnectionManager
+from logger import Logger
+from settings import Settings
+from webhook import (
+    ChatSequencer,
+    check_secret,
+    feed_update,
+    serve,
+    set_webhook,
+    user_key,
+)
+
+# Seconds to wait for a long polling response
+POLLING_TIMEOUT = 30
+
+
+def run_worker(index: int, processes: int, queue: Queue) -> None:
+    """
+    Entry point of a worker process
+    """
+    try:
+        asyncio.run(work(index, processes, queue))
+    except KeyboardInterrupt:
+        pass
+
+
+async def work(index: int, processes: int, queue: Queue) -> None:
+    """
+    Handles updates received from the supervisor until it sends None.\n
+    At most supervisor_queue_size updates are in flight; beyond that the queue isn't read,
+    so it fills up and the supervisor waits to put more.
+    """
+    # main imports this module to start the supervisor
+    from main import create_game
+
+    game = await create_game(index, processes)
+    if not game:
+        await ConnectionManager.close_pool()
+        return
+    loop = asyncio.get_running_loop()
+    sequencer = ChatSequencer()
+    in_flight = asyncio.Semaphore(Settings.supervisor_queue_size)
+
+    async def handle(data: dict[str, Any]) -> None:
+        try:
+            await feed_update(game.dp, game.bot, data)
+        finally:
+            in_flight.release()
+
+    try:
+        while True:
+            await in_flight.acquire()
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            sequencer.submit(user_key(data), lambda data=data: handle(data))
+    finally:
+        await game.bot.session.close()
+        await ConnectionManager.close_pool()
+
+
+class Supervisor:
+    """
+    Starts and restarts the worker processes and distributes updates between them
+    """
+
+    def __init__(self, processes: int) -> None:
+        self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
+        self.processes = processes
+        self.context = multiprocessing.get_context("spawn")
+        self.queues: list[Queue] = [
+            self.context.Queue(Settings.supervisor_queue_size) for _ in range(processes)
+        ]
+        self.workers: list[BaseProcess | None] = [None] * processes
+        self.sequencer = ChatSequencer()
+
+    def start_worker(self, index: int) -> None:
+        worker = self.context.Process(
+            target=run_worker,
+            args=(index, self.processes, self.queues[index]),
+            name=f"bot-worker-{index}",
+        )
+        worker.start()
+        self.workers[index] = worker
+        self.logger.info(
+            f"Started worker {index} (pid {worker.pid}){' as leader' if index == 0 else ''}"
+        )
+
+    async def watch(self) -> None:
+        """
+        Restarts workers that exited
+        """
+        while True:
+            await asyncio.sleep(5)
+            for index, worker in enumerate(self.workers):
+                if worker is not None and not worker.is_alive():
+                    self.logger.error(
+                        f"Worker {index} exited with code {worker.exitcode}; Restarting..."
+                    )
+                    self.start_worker(index)
+
+    async def dispatch(self, data: dict[str, Any]) -> None:
+        """
+        Passes the raw update to the worker owning its user, waiting if its queue is full
+        """
+        key = user_key(data)
+        queue = self.queues[key % self.processes]
+        loop = asyncio.get_running_loop()
+        await self.sequencer.submit(
+            key, lambda: loop.run_in_executor(None, queue.put, data)
+        )
+
+    async def poll(self) -> None:
+        """
+        Receives updates by long polling, without parsing them
+        """
+        url = PRODUCTION.api_url(Settings.token, "getUpdates")
+        offset = 0
+        timeout = ClientTimeout(total=POLLING_TIMEOUT + 10)
+        async with ClientSession(timeout=timeout) as session:
+            while True:
+                try:
+                    async with session.post(
+                        url, json={"offset": offset, "timeout": POLLING_TIMEOUT}
+                    ) as response:
+                        payload = await response.json()
+                    if not payload.get("ok"):
+                        raise RuntimeError(payload.get("description"))
+                except (
+                    asyncio.TimeoutError,
+                    ClientError,
+                    RuntimeError,
+                    ValueError,
+                ) as e:
+                    self.logger.error(f"Failed to fetch updates: {e}")
+                    await asyncio.sleep(5)
+                    continue
+                for data in payload["result"]:
+                    await self.dispatch(data)
+                    offset = data["update_id"] + 1
+
+    async def receive_webhook(self) -> None:
+        """
+        Receives updates on the webhook endpoint
+        """
+
+        async def handle(request: web.Request) -> web.Response:
+            if not check_secret(request):
+                return web.Response(status=401)
+            await self.dispatch(await request.json())
+            return web.Response()
+
+        bot = Bot(token=Settings.token, default=DefaultBotProperties())
+        try:
+            await set_webhook(bot)
+        finally:
+            await bot.session.close()
+        app = web.Application()
+        app.router.add_post(Settings.webhook_path, handle)
+        await serve(app)
+
+    async def run(self) -> None:
+        for index in range(self.processes):
+            self.start_worker(index)
+        watcher = asyncio.create_task(self.watch())
+        try:
+            if Settings.update_mode == "webhook":
+                await self.receive_webhook()
+            else:
+                await self.poll()
+        finally:
+            watcher.cancel()
+            self.stop()
+
+    def stop(self) -> None:
+        self.logger.info("Stopping workers")
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            if worker is None:
+                continue
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+
+
+def run_supervisor() -> None:
+    try:
+        asyncio.run(Supervisor(Settings.processes).run())
+    except KeyboardInterrupt:
+        pass
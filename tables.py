@@ -8,6 +8,9 @@ Usage:
     migrate              Run all migrations and create database if needed.
     create_db            Create the  database
     drop_db              Drop the database
+    check_income         Find users whose stored income drifted from their buildings
+    repair_income        Recalculate stored income of drifted users
+    check_statements     Prepare every named SQL statement against the current schema
 
     Deprecated options:
     create:              Create tables
@@ -16,12 +19,31 @@ Usage:
 """
 
 import asyncio
+import hashlib
 import os
+import re
 import sys
+import time
 
-from database import ConnectionManager
+import asyncpg
+
+from database import ConnectionManager, StatementConnection
 from logger import Logger
 from settings import Settings
+from users.user_repo import UserDAO
+
+MIGRATIONS_DIR = os.path.join(os.path.curdir, "migrations")
+# Key of the advisory lock held while applying migrations
+MIGRATIONS_LOCK = 0x6D696772
+# First line of the migrations that can't run inside a transaction
+NO_TRANSACTION = "-- migrate:no-transaction"
+# Creates the migrations table or adds the columns missing in the ones created by older versions
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS migrations (id SERIAL PRIMARY KEY, filename VARCHAR(255) NOT NULL);
+ALTER TABLE migrations
+    ADD COLUMN IF NOT EXISTS checksum CHAR(64),
+    ADD COLUMN IF NOT EXISTS applied_at TIMESTAMPTZ NOT NULL DEFAULT now();
+"""
 
 
 class MigrationManager:
@@ -108,11 +130,91 @@ class MigrationManager:
         await self.drop_tables()
         await self.create_tables()
 
+    @staticmethod
+    def read_migrations() -> list[tuple[str, str, str]]:
+        """
+        Reads the non-empty migrations of the ./migrations directory in the order they are applied
+        :returns: filename, text and checksum of every migration
+        """
+        migrations = []
+        for file in sorted(os.listdir(MIGRATIONS_DIR)):
+            if not file.endswith(".sql"):
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, file), "rb") as migration:
+                content = migration.read()
+            if content.strip():
+                migrations.append(
+                    (file, content.decode(), hashlib.sha256(content).hexdigest())
+                )
+        return migrations
+
+    async def pending(
+        self, connection: StatementConnection, migrations: list[tuple[str, str, str]]
+    ) -> tuple[list[tuple[str, str, str]], list[tuple[str, str, str]]] | None:
+        """
+        Compares the migrations with the applied ones, loaded in a single query
+        :returns: migrations to apply and applied migrations recorded without a checksum,
+        None if the migrations table is missing or outdated
+        :raises RuntimeError: if an applied migration was changed since
+        """
+        try:
+            applied = {
+                row["filename"]: row["checksum"]
+                for row in await connection.named_fetch("migrations.applied")
+            }
+        except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+            return None
+        changed = [
+            file
+            for file, _, checksum in migrations
+            if applied.get(file) not in (None, checksum)
+        ]
+        if changed:
+            raise RuntimeError(
+                "Applied migrations were changed, add new migrations instead: "
+                + ", ".join(changed)
+            )
+        return (
+            [migration for migration in migrations if migration[0] not in applied],
+            [
+                migration
+                for migration in migrations
+                if migration[0] in applied and applied[migration[0]] is None
+            ],
+        )
+
+    async def apply(
+        self, connection: StatementConnection, file: str, text: str, checksum: str
+    ) -> None:
+        """
+        Applies the migration and records it in one transaction.\n
+        Migrations starting with the NO_TRANSACTION marker (e.g. for CREATE INDEX CONCURRENTLY) are run
+        statement by statement outside a transaction, split at semicolons ending a line, and recorded afterwards,
+        so their statements should be idempotent and must not contain function bodies.
+        """
+        start = time.perf_counter()
+        if text.lstrip().startswith(NO_TRANSACTION):
+            for statement in re.split(r";[ \t]*$", text, flags=re.MULTILINE):
+                if statement.strip():
+                    await connection.execute(statement)
+            await connection.named_execute("migrations.record", file, checksum)
+        else:
+            async with connection.transaction():
+                await connection.execute(text)
+                await connection.named_execute("migrations.record", file, checksum)
+        self.logger.info(
+            f"Migration applied: {file} in {time.perf_counter() - start:.3f}s"
+        )
+
     @Logger.log_exception
     async def migrate(self):
         """
         Automatically finds migrations defined in the ./migrations directory and applies them \n
         For convenience (and possibly correct behavior as a migrations are sorted like strings) migrations should be named xxxx_MigrationName.sql where xxxx is the serial number of the migration\n
+        Every migration is applied in its own transaction and recorded with the checksum of its content;
+        changing an applied migration stops the migration.\n
+        Safe to run from several containers at once: runners apply migrations while holding an advisory lock,
+        the others wait for it and find nothing to apply. Nothing is locked if everything is applied already.\n
         Automatically creates database if it doesn't already exist
         """
         check = await self.ConnectionManager.check_database()
@@ -126,33 +228,35 @@ class MigrationManager:
                     "Error while creating database: %s; Shutting down..." % str(e)
                 )
                 return
-        async with self.ConnectionManager as connection:
-            await connection.execute(
-                "CREATE TABLE IF NOT EXISTS migrations (id SERIAL PRIMARY KEY, filename VARCHAR(255) NOT NULL)"
-            )
-            migrations_dir = os.path.join(
-                os.path.curdir, os.path.dirname("migrations/")
-            )
-            for file in sorted(os.listdir(migrations_dir)):
-                if file.endswith(".sql"):
-                    self.logger.debug("Found migraitions file: %s" % file)
-                    if await connection.fetchrow(
-                        "SELECT * FROM migrations WHERE filename = $1", file
-                    ):
-                        self.logger.debug("Migration already applied: %s" % file)
-                        continue
-                    with open(os.path.join(migrations_dir, file), "r") as migration:
-                        text = migration.read()
-                        if not text:
-                            self.logger.debug(
-                                "Migration file is empty or incorrect: %s" % file
-                            )
-                            continue
-                        await connection.execute(text)
-                        await connection.execute(
-                            "INSERT INTO migrations (filename) VALUES ($1)", file
-                        )
-                        self.logger.debug("Migration applied: %s" % file)
+        migrations = self.read_migrations()
+        connection = await self.ConnectionManager.connect(
+            connection_class=StatementConnection
+        )
+        try:
+            if await self.pending(connection, migrations) == ([], []):
+                self.logger.debug("Migrations are up to date")
+                return
+            await connection.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK)
+            try:
+                # Another runner may have applied everything while this one waited for the lock
+                pending = await self.pending(connection, migrations)
+                if pending is None:
+                    await connection.execute(MIGRATIONS_TABLE)
+                    pending = await self.pending(connection, migrations)
+                to_apply, unchecked = pending  # type: ignore[misc]
+                for file, _, checksum in unchecked:
+                    await connection.named_execute(
+                        "migrations.set_checksum", file, checksum
+                    )
+                for migration in to_apply:
+                    await self.apply(connection, *migration)
+                self.logger.info(f"Migrations applied: {len(to_apply)}")
+            finally:
+                await connection.execute(
+                    "SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK
+                )
+        finally:
+            await connection.close()
 
     @Logger.log_exception
     async def drop_db(self):
@@ -170,6 +274,37 @@ class MigrationManager:
         self.logger.debug("Creating database: %s" % Settings.database_name)
         await self.ConnectionManager.create_database()
 
+    @Logger.log_exception
+    async def check_income(self):
+        """
+        Reports users whose stored income doesn't match their buildings
+        """
+        drift = await UserDAO().find_income_drift()
+        for row in drift:
+            self.logger.warning(
+                f"User {row['telegram_id']} income drift: "
+                f"stored {row['stored']}, actual {row['actual']}"
+            )
+        self.logger.info(f"Users with income drift: {len(drift)}")
+        return drift
+
+    @Logger.log_exception
+    async def repair_income(self):
+        """
+        Recalculates stored income of every drifted user
+        """
+        repaired = await UserDAO().repair_income_drift()
+        self.logger.info(f"Users with repaired income: {repaired}")
+
+    @Logger.log_exception
+    async def check_statements(self):
+        """
+        Prepares every named statement, reports those broken by the schema
+        """
+        failed = await self.ConnectionManager.check_statements()
+        self.logger.info(f"Statements failed to prepare: {len(failed)}")
+        return failed
+
 
 async def main():
     if len(sys.argv) < 2:
@@ -181,6 +316,9 @@ async def main():
         migrate              Run all migrations and create database if needed.
         create_db            Create the  database
         drop_db              Drop the database
+        check_income         Find users whose stored income drifted from their buildings
+        repair_income        Recalculate stored income of drifted users
+        check_statements     Prepare every named SQL statement against the current schema
 
         Deprecated options:
         create:              Create tables
@@ -201,6 +339,12 @@ async def main():
         await migrations.drop_db()
     elif sys.argv[1] == "create_db":
         await migrations.create_db()
+    elif sys.argv[1] == "check_income":
+        await migrations.check_income()
+    elif sys.argv[1] == "repair_income":
+        await migrations.repair_income()
+    elif sys.argv[1] == "check_statements":
+        await migrations.check_statements()
     else:
         print("Unknown command")
         print("""
@@ -212,12 +356,16 @@ async def main():
         migrate              Run all migrations and create database if needed.
         create_db            Create the  database
         drop_db              Drop the database
+        check_income         Find users whose stored income drifted from their buildings
+        repair_income        Recalculate stored income of drifted users
+        check_statements     Prepare every named SQL statement against the current schema
 
         Deprecated options:
         create:              Create tables
         drop:                Drop tables
         recreate:            Recreates tables
         """)
+    await ConnectionManager.close_pool()
 
 
 if __name__ == "__main__":
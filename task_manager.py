@@ -1,48 +1,92 @@
 import asyncio
-from typing import Any, Callable, Coroutine, Iterable, Optional
+from collections.abc import Callable, Coroutine, Iterable
+from typing import Any
 
+import redis.asyncio as aioredis
+from celery import states
 from celery.result import AsyncResult
 
 from celery_tasks import app
 from logger import Logger
+from settings import Settings
+
+# Seconds a handled result stays claimed, so other replicas skip it
+RESULT_CLAIM_TTL = 86400
 
 
 class TaskManager:
     """
-    Convenience class for managing celery tasks, providing methods for applying tasks and w
+    Convenience class for managing celery tasks, providing methods for applying tasks and waiting for their results.\n
+    Results are delivered by the redis result backend pub/sub, so callbacks fire as soon as a task is finished.\n
+    With handle_results=False results are not consumed at all, which lets several bot processes
+    share one result handling process: handlers registered with on_result receive results of tasks
+    started by any process. Every result is claimed in redis before it is handled,
+    so replicas subscribed to the same backend never handle a result twice.\n
+    Backends without pub/sub are polled task by task, so every process polls the tasks it started itself.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, handle_results: bool = True) -> None:
         self.logger = Logger("TaskManager").get_logger()
         self.tasks: dict[
-            AsyncResult, Optional[tuple[Callable, list[Any], dict[Any, Any]]]
+            str,
+            tuple[
+                AsyncResult,
+                tuple[Callable, list[Any], dict[Any, Any]] | None,
+                dict[str, Any],
+            ],
         ] = {}
-        asyncio.create_task(self.catch_results())
+        self.handlers: dict[str, Callable[..., Coroutine[Any, Any, Any]]] = {}
+        pubsub = bool(Settings.backend and Settings.backend.startswith("redis"))
+        # Only the process draining the results keeps track of applied tasks
+        self.tracking = handle_results or not pubsub
+        if not self.tracking:
+            return
+        if pubsub:
+            asyncio.create_task(self.catch_results())
+        else:
+            asyncio.create_task(self.poll_results())
+
+    def on_result(
+        self, task: Callable, callback: Callable[..., Coroutine[Any, Any, Any]]
+    ) -> None:
+        """
+        Registers callback for results of every task of the given type,
+        it is called with the result followed by the task arguments
+        """
+        self.handlers[task.name] = callback  # type: ignore[attr-defined]
 
     def apply_with_delay(
         self,
         task: Callable,
         delay: int = 0,
-        args: Optional[Iterable[Any]] = None,
-        kwargs: Optional[dict[Any, Any]] = None,
-        callback: Optional[Callable[..., Coroutine[Any, Any, Any]]] = None,
+        args: Iterable[Any] | None = None,
+        kwargs: dict[Any, Any] | None = None,
+        callback: Callable[..., Coroutine[Any, Any, Any]] | None = None,
         args_for_callback=None,
         kwargs_for_callback=None,
     ) -> AsyncResult:
-        self.logger.info(f"Applying task {task.__name__}, with delay {delay} seconds")
+        self.logger.info(
+            f"Applying task {task.__name__}, with delay {delay} seconds",
+            extra=Logger.sampled(),
+        )
         _task = task.apply_async(args, kwargs, countdown=delay)  # type: ignore[attr-defined]
         self.logger.debug(f"Applied task id {_task}")
-        self.tasks.update(
-            {
-                _task: [callback, args_for_callback, kwargs_for_callback]
+        if self.tracking:
+            self.tasks[_task.id] = (
+                _task,
+                (callback, args_for_callback or [], kwargs_for_callback or {})
                 if callback
-                else None
-            }
-        )
+                else None,
+                {"name": task.name, "args": args, "kwargs": kwargs},  # type: ignore[attr-defined]
+            )
+        elif callback:
+            self.logger.warning(
+                f"Callback of task {_task} is never called, results are handled by another process"
+            )
         return _task
 
     def wait(self, task):
-        if task in self.tasks:
+        if task.id in self.tasks or not self.tracking:
             return task.get()
         return ValueError(
             f"{task} should be a valid task, started by this task manager"
@@ -56,24 +100,116 @@ class TaskManager:
             interval, sig=task.s(), args=[*args], kwargs={**kwargs}, name=task.__name__
         )
 
+    async def finish(
+        self, task_id: str, result: Any, state: str, meta: dict | None = None
+    ) -> bool:
+        """
+        Executes the callback of a finished task and forgets it once the callback succeeds.
+        Tasks applied without a callback are passed to the handler registered for their type.
+        Results of failed tasks are passed as the exception raised by the task.
+        :param meta: name and arguments of the task stored with the result, known for tasks applied by this manager
+        :returns: True if the task was started by this task manager or has a registered handler
+        """
+        callback_info = None
+        if task_id in self.tasks:
+            _, callback_info, meta = self.tasks[task_id]
+        elif not meta or meta.get("name") not in self.handlers:
+            return False
+        if state == states.SUCCESS:
+            self.logger.info(
+                f"Task {task_id} result: {result}, {state}", extra=Logger.sampled()
+            )
+        else:
+            if isinstance(result, dict):
+                result = app.backend.exception_to_python(result)
+            self.logger.error(f"Task {task_id} {state}: {result!r}")
+        if callback_info:
+            callback, args, kwargs = callback_info
+            await callback(result, *args, **kwargs)
+        elif meta and meta.get("name") in self.handlers:
+            await self.handlers[meta["name"]](
+                result, *(meta.get("args") or []), **(meta.get("kwargs") or {})
+            )
+        self.tasks.pop(task_id, None)
+        return True
+
+    async def deliver(self, client, meta: dict, key) -> None:
+        """
+        Claims the stored result for this process and finishes its task,
+        the result is deleted once handled and the claim is released if it isn't ours
+        or its callback failed, so the result is retried after resubscribing
+        """
+        claim = f"task-claim:{meta['task_id']}"
+        if not await client.set(claim, 1, nx=True, ex=RESULT_CLAIM_TTL):
+            return
+        try:
+            handled = await self.finish(
+                meta["task_id"], meta["result"], meta["status"], meta
+            )
+        except Exception:
+            self.logger.exception(f"Callback of task {meta['task_id']} failed")
+            handled = False
+        if handled:
+            await client.delete(key)
+        else:
+            await client.delete(claim)
+
     async def catch_results(self):
+        """
+        Listens to the result backend notifications and finishes tasks as soon as their result is stored.\n
+        Cost does not depend on the number of pending tasks; they are only checked one by one after (re)subscribing.
+        """
+        prefix = app.backend.get_key_for_task("").decode()
+        while True:
+            client = aioredis.from_url(Settings.backend)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(f"{prefix}*")
+                    self.logger.info("Subscribed to task results")
+                    await self.reconcile(client)
+                    async for message in pubsub.listen():
+                        if message["type"] != "pmessage":
+                            continue
+                        meta = app.backend.decode_result(message["data"])
+                        if meta["status"] not in states.READY_STATES:
+                            continue
+                        await self.deliver(client, meta, message["channel"])
+            except Exception:
+                self.logger.exception("Task results subscription failed")
+                await asyncio.sleep(5)
+            finally:
+                await client.aclose()
+
+    async def reconcile(self, client):
+        """
+        Finishes tasks whose results were stored while nobody was subscribed
+        """
+        keys = [app.backend.get_key_for_task(task_id) for task_id in self.tasks]
+        if self.handlers:
+            prefix = app.backend.get_key_for_task("").decode()
+            keys += [key async for key in client.scan_iter(match=f"{prefix}*")]
+        for key in keys:
+            payload = await client.get(key)
+            if not payload:
+                continue
+            meta = app.backend.decode_result(payload)
+            if meta["status"] not in states.READY_STATES:
+                continue
+            await self.deliver(client, meta, key)
+
+    async def poll_results(self):
+        """
+        Fallback for result backends without pub/sub support
+        """
         while True:
-            for task in list(self.tasks):
+            for task_id in list(self.tasks):
+                task = self.tasks[task_id][0]
                 self.logger.debug(f"{task.id}: {task.state}")
-                if task.state == "SUCCESS" or task.state == "FAILURE":
-                    self.logger.info(f"Task {task} result: {task.result}, {task.state}")
-                    if self.tasks[task]:
-                        self.logger.info(
-                            f"Executing callback for task {task} result: {task.result}, {task.state}"
-                        )
-                        callback, args, kwargs = self.tasks[task]
-                        if callback:
-                            res = task.result
-                            if not args:
-                                args = []
-                            if not kwargs:
-                                kwargs = {}
-                            await callback(res, *args, **kwargs)
-                    self.tasks.pop(task)
+                if task.state in states.READY_STATES:
+                    try:
+                        await self.finish(task_id, task.result, task.state)
+                    except Exception:
+                        self.logger.exception(f"Callback of task {task_id} failed")
+                        self.tasks.pop(task_id, None)
                     task.forget()
             await asyncio.sleep(3)
@@ -17,3 +17,13 @@ class UserTask(BaseModel):
     def get_info(self):
         """Returns a formatted string containing the task's details for user."""
         return f"{self.name} [{self.cost}$ {self.lvl_required} LVL]: {self.reward}$ + {self.exp_reward}exp, {self.length}m"
+
+
+class CompletedTask(BaseModel):
+    """
+    Represents a task completed by the scheduler, used to notify the user.
+    """
+
+    telegram_id: int
+    task_id: int
+    levels: list[int] = []
@@ -1,8 +1,10 @@
 from enum import Enum
 
+from catalog import catalog
 from database import ConnectionManager
 from logger import Logger
-from tasks.schema import UserTask
+from settings import Settings
+from tasks.schema import CompletedTask, UserTask
 from users.user_repo import UserDAO
 
 
@@ -16,115 +18,132 @@ class TaskStatus(Enum):
 class UserTaskDAO:
     def __init__(self) -> None:
         self.connection_manager = ConnectionManager()
+        self.user_dao = UserDAO()
         self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
 
     @Logger.log_exception
-    async def get_tasks(self, telegram_id) -> list[UserTask]:
+    async def get_tasks(
+        self, telegram_id, prestige: int | None = None
+    ) -> list[UserTask]:
         """
         Method to return all tasks with prestige calculation.
+        Prestige is looked up unless provided.
         """
-        async with self.connection_manager as conn:
-            prestige = await conn.fetchval(
-                "SELECT prestige FROM users WHERE telegram_id = $1", telegram_id
-            )
-        tasks = await self.connection_manager.fetch_objects(
-            "SELECT id, name, reward*$1 as reward, exp_reward*$1 as exp_reward, lvl_required, cost, length FROM user_tasks",
-            UserTask,
-            prestige,
-        )
-        return tasks
+        if prestige is None:
+            prestige = await self.user_dao.get_prestige(telegram_id)
+        return await catalog.get_tasks(prestige)
 
-    async def task_completed(self, telegram_id, task_id) -> int | None:
+    async def task_completed(self, telegram_id, task_id) -> list[int]:
         """
         Method to reward task completion
         """
-        async with self.connection_manager as conn:
-            prestige = await conn.fetchval(
-                "SELECT prestige FROM users WHERE telegram_id = $1", telegram_id
-            )
+        completed = await self.complete_tasks([(telegram_id, task_id)])
+        if not completed:
+            self.logger.warning(f"Task {task_id} of {telegram_id} is already completed")
+            return []
+        self.logger.info(
+            f"Task completion {task_id} by {telegram_id}", extra=Logger.sampled()
+        )
+        return completed[0].levels
 
-            reward, exp_reward = await conn.fetchrow(
-                "SELECT reward, exp_reward FROM user_tasks WHERE id = $1", task_id
-            )
-            reward *= prestige
-            exp_reward *= prestige
-            await conn.execute(
-                "UPDATE users SET currency = currency + $1 WHERE telegram_id = $2",
-                reward,
-                telegram_id,
-            )
-            await conn.execute(
-                "DELETE FROM user_user_tasks WHERE user_id = (SELECT id FROM users WHERE telegram_id = $1)",
-                telegram_id,
+    @Logger.log_exception
+    async def complete_tasks(
+        self, completions: list[tuple[int, int]]
+    ) -> list[CompletedTask]:
+        """
+        Completes the given (telegram_id, task_id) pairs in a single transaction.\n
+        Pairs whose task is no longer active are skipped, so a completion is never rewarded twice.
+        :returns: completed tasks with the reached level
+        """
+        async with self.connection_manager as conn, conn.transaction():
+            rows = await conn.named_fetch(
+                "tasks.complete",
+                [telegram_id for telegram_id, _ in completions],
+                [task_id for _, task_id in completions],
             )
-            res = await UserDAO().get_xp(telegram_id, exp_reward)
-            self.logger.info(f"Task completion {task_id} by {telegram_id}")
-            return res
+            return await self.apply_levels(conn, rows)
 
-    async def get_task(self, telegram_id, task_id) -> UserTask:
+    async def apply_levels(self, conn, rows) -> list[CompletedTask]:
         """
-        Method to get task by id
+        Applies level ups for the rewarded users, should be called within the rewarding transaction
         """
-        async with self.connection_manager as conn:
-            prestige = await conn.fetchval(
-                "SELECT prestige FROM users WHERE telegram_id = $1", telegram_id
-            )
-            task = await self.connection_manager.fetch_objects(
-                "SELECT id, name, reward*$1 as reward, exp_reward*$1 as exp_reward, lvl_required, cost, length FROM user_tasks WHERE id = $2",
-                UserTask,
-                prestige,
-                task_id,
+        levels = await self.user_dao.apply_levels(conn, rows)
+        return [
+            CompletedTask(
+                telegram_id=row["telegram_id"],
+                task_id=row["task_id"],
+                levels=levels[row["telegram_id"]],
             )
-            task = task[0]
-            return task
-
-    async def can_afford(self, telegram_id, task_id):
-        """Method to check if user can afford a task
+            for row in rows
+        ]
 
-        :param telegram_id: telegram id of user
-        :param task_id: id of the task
+    async def get_task(
+        self, telegram_id, task_id, prestige: int | None = None
+    ) -> UserTask | None:
         """
-        active_task = await self.get_active_user_task(telegram_id)
-        self.logger.debug(f"for user {telegram_id}: {active_task}")
-        if active_task:
-            return TaskStatus.ALREADY_EXECUTED
-        async with self.connection_manager as conn:
-            cost = await conn.fetchval(
-                "SELECT cost FROM user_tasks WHERE id = $1", task_id
-            )
-            currency = await conn.fetchval(
-                "SELECT currency FROM users WHERE telegram_id = $1", telegram_id
-            )
-            if currency < cost:
-                return TaskStatus.NOT_ENOUGH_MONEY
-            lvl = await conn.fetchval(
-                "SELECT lvl FROM users WHERE telegram_id = $1", telegram_id
-            )
-            lvl_required = await conn.fetchval(
-                "SELECT lvl_required FROM user_tasks WHERE id = $1", task_id
-            )
-            if lvl < lvl_required:
-                return TaskStatus.INSUFFICIENT_LEVEL
-        return TaskStatus.OK
+        Method to get task by id, None if it doesn't exist
+        Prestige is looked up unless provided.
+        """
+        if prestige is None:
+            prestige = await self.user_dao.get_prestige(telegram_id)
+        return await catalog.get_task(task_id, prestige)
 
     async def get_active_user_task(self, telegram_id) -> int | None:
         """
         Method to get active user task
         """
         async with self.connection_manager as conn:
-            return await conn.fetchval(
-                "SELECT task_id FROM user_user_tasks WHERE user_id = (SELECT id FROM users WHERE telegram_id = $1)",
+            return await conn.named_fetchval(
+                "tasks.get_active",
                 telegram_id,
             )
 
-    async def start_task(self, telegram_id, task_id):
+    @Logger.log_exception
+    async def start_task(
+        self, telegram_id, task_id
+    ) -> tuple[TaskStatus, UserTask, UserTask | None] | None:
         """
-        Method to start user task
+        Method to start user task\n
+        Checks the active task, funds and level, debits the cost and starts the task
+        in a single atomic statement, so concurrent taps can't start two tasks or charge twice.
+        :returns: status, the task and the already active task (if any) scaled by prestige,
+        None if the user or the task doesn't exist
         """
-        self.logger.info(f"Starting task for user {telegram_id}")
+        self.logger.info(
+            f"Starting task for user {telegram_id}", extra=Logger.sampled()
+        )
         async with self.connection_manager as conn:
-            await conn.execute(
-                "INSERT INTO user_user_tasks (user_id, task_id) VALUES ((SELECT id FROM users WHERE telegram_id = $1), $2)",
+            row = await conn.named_fetchrow(
+                "tasks.start",
                 telegram_id,
                 task_id,
+                self.user_dao.accrual_interval(),
+                Settings.currency_tick_interval,
+            )
+        if not row:
+            return None
+        task = await catalog.get_task(task_id, row["prestige"])
+        if task is None:
+            return None
+        active_task = None
+        if row["active_task_id"]:
+            active_task = await catalog.get_task(row["active_task_id"], row["prestige"])
+        return TaskStatus(row["status"]), task, active_task
+
+    @Logger.log_exception
+    async def complete_due_tasks(self, limit: int) -> list[CompletedTask]:
+        """
+        Completes up to limit tasks whose time has come, rewarding currency and experience
+        with a single statement and applying level ups in the same transaction.\n
+        Safe to run from several processes at once.
+        :returns: completed tasks for notification
+        """
+        async with self.connection_manager as conn, conn.transaction():
+            rows = await conn.named_fetch(
+                "tasks.complete_due",
+                limit,
             )
+            completed = await self.apply_levels(conn, rows)
+        if completed:
+            self.logger.info(f"Completed {len(completed)} due tasks")
+        return completed
@@ -16,6 +16,10 @@ class Reward(ABC):
         """Returns SQL script for the reward. Should be used with $1 user (telegram_id) parameter only"""
         pass
 
+    def to_currency(self) -> int | None:
+        """Returns currency amount if the reward is plain currency, so that rewards of several levels can be summed up and applied at once"""
+        return None
+
 
 class Currency(Reward):
     def __init__(self, amount) -> None:
@@ -27,5 +31,8 @@ class Currency(Reward):
     def to_sql(self):
         return f"UPDATE users SET currency = currency + {self.amount} WHERE telegram_id = $1"
 
+    def to_currency(self):
+        return self.amount
+
 
 REWARD_DICT: dict[int, Reward] = {i: Currency(i * 2000) for i in range(100)}
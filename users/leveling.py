@@ -0,0 +1,25 @@
+from settings import Settings
+
+
+def apply_xp(level: int, xp: int, amount: int) -> tuple[int, int, list[int]]:
+    """
+    Computes level and experience after gaining amount of experience,
+    using the closed form of total experience needed for a level instead of leveling up one by one.
+    :returns: new level, new experience and every level reached on the way
+    """
+    total = Settings.required_xp_total_formula(level) + xp + amount
+    # Largest level whose total requirement is covered: exponential search, then bisection
+    low, high = level, level + 1
+    while Settings.required_xp_total_formula(high) <= total:
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if Settings.required_xp_total_formula(middle) <= total:
+            low = middle
+        else:
+            high = middle
+    return (
+        low,
+        total - Settings.required_xp_total_formula(low),
+        list(range(level + 1, low + 1)),
+    )
@@ -0,0 +1,16 @@
+from pydantic import BaseModel
+
+
+class PlayerSnapshot(BaseModel):
+    """
+    Model for the player state shown by the handlers, fetched in one query.
+    """
+
+    currency: int
+    income: int
+    level: int
+    xp: int
+    xp_needed: int
+    prestige: int
+    active_task_id: int | None = None
+    buildings: dict[int, int] = {}
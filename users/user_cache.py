@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+
+from settings import Settings
+
+
+class RegisteredUserCache:
+    """
+    In-process cache of user registration status.\n
+    Registered users are kept in a bounded LRU, unregistered ones are remembered
+    for a short TTL only so that a registration on another instance is picked up quickly.
+    """
+
+    def __init__(self, max_size: int, negative_ttl: float) -> None:
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.registered: OrderedDict[int, None] = OrderedDict()
+        self.unregistered: OrderedDict[int, float] = OrderedDict()
+
+    def get(self, telegram_id: int) -> bool | None:
+        """
+        Returns cached registration status, None if unknown
+        """
+        if telegram_id in self.registered:
+            self.registered.move_to_end(telegram_id)
+            return True
+        expires = self.unregistered.get(telegram_id)
+        if expires is not None:
+            if expires > time.monotonic():
+                return False
+            del self.unregistered[telegram_id]
+        return None
+
+    def set(self, telegram_id: int, registered: bool) -> None:
+        """
+        Remembers registration status of the user
+        """
+        if registered:
+            self.unregistered.pop(telegram_id, None)
+            self.registered[telegram_id] = None
+            self.registered.move_to_end(telegram_id)
+            if len(self.registered) > self.max_size:
+                self.registered.popitem(last=False)
+        else:
+            self.registered.pop(telegram_id, None)
+            self.unregistered[telegram_id] = time.monotonic() + self.negative_ttl
+            self.unregistered.move_to_end(telegram_id)
+            if len(self.unregistered) > self.max_size:
+                self.unregistered.popitem(last=False)
+
+    def discard(self, telegram_id: int) -> None:
+        """
+        Forgets everything known about the user
+        """
+        self.registered.pop(telegram_id, None)
+        self.unregistered.pop(telegram_id, None)
+
+    def clear(self) -> None:
+        self.registered.clear()
+        self.unregistered.clear()
+
+    def on_users_changed(self, payload: str) -> None:
+        """
+        Handles users_changed notifications ("insert:<telegram_id>" or "delete:<telegram_id>")
+        """
+        operation, telegram_id = payload.split(":")
+        if operation == "insert":
+            self.set(int(telegram_id), True)
+        else:
+            self.discard(int(telegram_id))
+
+
+registered_users = RegisteredUserCache(
+    Settings.user_cache_size, Settings.user_cache_negative_ttl
+)
@@ -1,7 +1,12 @@
+from datetime import datetime
+
 from database import ConnectionManager
+from leaderboard import leaderboard
 from logger import Logger
 from settings import Settings
 from users.level_rewards import REWARD_DICT
+from users.leveling import apply_xp
+from users.schemas import PlayerSnapshot
 
 
 class UserDAO:
@@ -13,6 +18,16 @@ class UserDAO:
         self.connection_manager = ConnectionManager()
         self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
 
+    @staticmethod
+    def accrual_interval() -> int | None:
+        """
+        Returns tick length in seconds used for lazy income settlement,
+        or None if income is paid by the global currency tick.
+        """
+        if Settings.currency_accrual == "lazy":
+            return Settings.currency_tick_interval
+        return None
+
     @Logger.log_exception
     async def update_currency(self, telegram_id: int, currency_amount: int) -> None:
         """Updates the currency (can be negative or positive)
@@ -22,11 +37,12 @@ class UserDAO:
         :return: nothing
         """
         async with self.connection_manager as conn:
-            await conn.execute(
-                "UPDATE users SET currency = currency + $1 WHERE telegram_id = $2",
+            currency = await conn.named_fetchval(
+                "users.update_currency",
                 currency_amount,
                 telegram_id,
             )
+        leaderboard.update(telegram_id, currency=currency)
 
     @Logger.log_exception
     async def get_level(self, telegram_id: int) -> tuple[int, int, int]:
@@ -34,36 +50,41 @@ class UserDAO:
         Returns user's current level, experience, and needed exp.
         """
         async with self.connection_manager as conn:
-            lvl, xp = await conn.fetchrow(
-                "SELECT lvl, xp FROM users WHERE telegram_id = $1", telegram_id
-            )
+            lvl, xp = await conn.named_fetchrow("users.get_level", telegram_id)
             max_exp = Settings.required_xp_formula(lvl)
             return (lvl, xp, max_exp)
 
     @Logger.log_exception
-    async def prestige_up(self, telegram_id: int) -> None:
+    async def prestige_up(
+        self, telegram_id: int, prestige: int
+    ) -> tuple[int, int, int] | None:
         """
         Increases user's prestige by 1 and gives them 1000$ currency for each prestige.
-        Deletes all user's buildings.
+        Deletes all user's buildings.\n
+        Checks the price and applies everything in one atomic statement; fails if the prestige
+        was changed concurrently, so a double tap can't prestige twice.
+        :param prestige: current prestige of the user, used to compute the price
+        :returns: new currency, income and prestige, None if the user can't afford prestige
         """
         async with self.connection_manager as conn:
-            await conn.execute(
-                "UPDATE users SET prestige = prestige + 1, lvl = 1, xp = 0 WHERE telegram_id = $1",
-                telegram_id,
-            )
-            prestige = await conn.fetchval(
-                "SELECT prestige FROM users WHERE telegram_id = $1", telegram_id
-            )
-            await conn.execute(
-                "UPDATE users SET currency = 1000*$2 WHERE telegram_id = $1",
+            row = await conn.named_fetchrow(
+                "users.prestige_up",
                 telegram_id,
+                self.accrual_interval(),
                 prestige,
+                Settings.prestige_formula(prestige),
             )
-            id = await conn.fetchval(
-                "SELECT id FROM users WHERE telegram_id = $1", telegram_id
-            )
-            await conn.execute("DELETE FROM users_buildings WHERE user_id = $1", id)
-            self.logger.info(f"User {telegram_id} prestiged up")
+            if not row:
+                return None
+        self.logger.info(f"User {telegram_id} prestiged up")
+        leaderboard.update(
+            telegram_id,
+            currency=row["currency"],
+            income=row["income"],
+            prestige=row["prestige"],
+            lvl=1,
+        )
+        return row["currency"], row["income"], row["prestige"]
 
     @Logger.log_exception
     async def register_user(self, telegram_id: int) -> None:
@@ -71,10 +92,9 @@ class UserDAO:
         Inserts new user into the database.
         """
         async with self.connection_manager as conn:
-            await conn.execute(
-                "INSERT INTO users (telegram_id) VALUES ($1)", telegram_id
-            )
-            self.logger.info(f"User {telegram_id} registered")
+            row = await conn.named_fetchrow("users.register", telegram_id)
+        self.logger.info(f"User {telegram_id} registered")
+        leaderboard.update(telegram_id, **dict(row))
 
     @Logger.log_exception
     async def check_user(self, telegram_id: int) -> bool:
@@ -84,58 +104,81 @@ class UserDAO:
         """
 
         async with self.connection_manager as conn:
-            result = await conn.fetchrow(
-                "SELECT * FROM users WHERE telegram_id = $1", telegram_id
-            )
+            result = await conn.named_fetchrow("users.check", telegram_id)
             if result:
                 return True
             else:
                 return False
 
     @Logger.log_exception
-    async def buy_building(self, telegram_id: int, building_id: int) -> bool:
+    async def buy_building(
+        self, telegram_id: int, building_id: int
+    ) -> tuple[int, int] | None:
         """
-        Attempts to buy building with given id for user with given telegram_id.
-        :returns: True if user can afford the building, False otherwise.
+        Attempts to buy building with given id for user with given telegram_id.\n
+        Settles pending income, checks funds, debits the cost, adds the building and its income
+        in one atomic statement, so concurrent purchases can't overspend.
+        :returns: new currency and income if user can afford the building, None otherwise.
         """
         async with self.connection_manager as conn:
-            can_afford = await conn.fetchval(
-                "SELECT u.currency >= (SELECT b.cost FROM buildings b WHERE b.id = $1) FROM users u WHERE u.telegram_id = $2",
-                building_id,
+            row = await conn.named_fetchrow(
+                "users.buy_building",
                 telegram_id,
-            )
-            if not can_afford:
-                self.logger.info((f"User {telegram_id} cannot afford {building_id}"))
-                return False
-
-            await conn.execute(
-                "UPDATE users SET currency = currency - (SELECT b.cost FROM buildings b WHERE b.id = $1) WHERE telegram_id = $2",
                 building_id,
-                telegram_id,
+                self.accrual_interval(),
             )
-            await conn.execute(
-                "INSERT INTO users_buildings (user_id, building_id, count) VALUES ((SELECT id FROM users WHERE telegram_id = $1), $2, 1) ON CONFLICT (user_id, building_id) DO UPDATE SET count = users_buildings.count + 1;",
-                telegram_id,
-                building_id,
+            if not row:
+                self.logger.info(
+                    f"User {telegram_id} cannot afford {building_id}",
+                    extra=Logger.sampled(),
+                )
+                return None
+        leaderboard.update(telegram_id, currency=row["currency"], income=row["income"])
+        return row["currency"], row["income"]
+
+    async def get_last_currency_tick(self) -> datetime:
+        """
+        Returns the time of the last finished global currency tick
+        """
+        async with self.connection_manager as conn:
+            return await conn.named_fetchval("users.get_last_currency_tick")
+
+    async def set_last_currency_tick(self, tick_at: datetime) -> None:
+        async with self.connection_manager as conn:
+            await conn.named_execute("users.set_last_currency_tick", tick_at)
+
+    async def set_accrual_interval(self) -> None:
+        """
+        Stores the tick length of lazy accrual, used by the catalog triggers to settle income before changing it
+        """
+        async with self.connection_manager as conn:
+            await conn.named_execute(
+                "users.set_accrual_interval", self.accrual_interval()
             )
-            return True
 
-    @Logger.log_exception
-    async def currency_tick(self):
+    async def get_max_user_id(self) -> int:
+        async with self.connection_manager as conn:
+            return await conn.named_fetchval("users.get_max_id")
+
+    async def currency_tick(
+        self, tick_at: datetime, ticks: int, start_id: int, end_id: int
+    ) -> int:
         """
-        Increases currency by income of all buildings owned by users.\n
-        Should be called periodically during the game.
+        Pays income of users with ids in [start_id, end_id) for the tick at tick_at (global currency tick mode only).\n
+        Pays at most ticks intervals per user, fewer for users already paid after the previous tick,
+        so repeating a partially done tick never pays anyone twice.
+        :returns: number of paid users
         """
         async with self.connection_manager as conn:
-            await conn.execute(
-                """UPDATE users SET currency = currency +
-                               (SELECT final_res FROM
-                               (SELECT user_id, SUM(result) as final_res FROM
-                               (SELECT ub.user_id,
-                               (SELECT count FROM users_buildings WHERE user_id = ub.user_id AND building_id=ub.building_id) * (SELECT income FROM buildings b WHERE b.id = ub.building_id) * (SELECT prestige FROM users uuu WHERE uuu.id = ub.user_id) AS result
-                               FROM users_buildings ub GROUP BY ub.user_id, ub.building_id) ass GROUP BY user_id) asss WHERE user_id = id) WHERE id IN (SELECT user_id FROM users_buildings)"""
+            result = await conn.named_execute(
+                "users.currency_tick",
+                start_id,
+                end_id,
+                tick_at,
+                ticks,
+                Settings.currency_tick_interval,
             )
-            self.logger.info("Currency ticked")
+            return int(result.split()[-1])
 
     @Logger.log_exception
     async def get_currency(self, telegram_id: int) -> int:
@@ -145,8 +188,10 @@ class UserDAO:
         :return: The user's currency
         """
         async with self.connection_manager as conn:
-            return await conn.fetchval(
-                "SELECT currency FROM users WHERE telegram_id = $1", telegram_id
+            return await conn.named_fetchval(
+                "users.get_currency",
+                telegram_id,
+                self.accrual_interval(),
             )
 
     async def get_income(self, telegram_id: int) -> int:
@@ -156,16 +201,54 @@ class UserDAO:
         :return: The user's income
         """
         async with self.connection_manager as conn:
-            return (
-                await conn.fetchval(
-                    """SELECT SUM(res) FROM
-                                         (SELECT user_id, (ub.count*(SELECT b.income FROM buildings b WHERE b.id = ub.building_id) * (SELECT prestige FROM users WHERE id = ub.user_id)) as res
-                                         FROM users_buildings ub
-                                         GROUP BY ub.user_id, ub.building_id, ub.count) temp
-                                         WHERE user_id = (SELECT id FROM users WHERE telegram_id = $1)""",
-                    telegram_id,
-                )
-                or 0
+            return await conn.named_fetchval("users.get_income", telegram_id)
+
+    @Logger.log_exception
+    async def find_income_drift(self) -> list:
+        """
+        Finds users whose stored income does not match their buildings.
+        :return: records with id, telegram_id, stored and actual income
+        """
+        async with self.connection_manager as conn:
+            return await conn.named_fetch("users.find_income_drift")
+
+    @Logger.log_exception
+    async def repair_income_drift(self) -> int:
+        """
+        Recalculates stored income of every drifted user in a single statement.\n
+        Also serves as a bulk recompute path after catalog changes made around the triggers.
+        :return: number of repaired users
+        """
+        async with self.connection_manager as conn:
+            repaired = await conn.named_fetch(
+                "users.repair_income_drift", self.accrual_interval()
+            )
+            self.logger.info(f"Repaired income of {len(repaired)} users")
+            return len(repaired)
+
+    @Logger.log_exception
+    async def get_player_snapshot(self, telegram_id: int) -> PlayerSnapshot:
+        """
+        Returns currency, income, level, prestige, active task and owned buildings
+        of the specified user in a single round trip (settling pending income on the way)
+        :param telegram_id: The telegram id of the user
+        :return: The user's snapshot
+        """
+        async with self.connection_manager as conn:
+            row = await conn.named_fetchrow(
+                "users.get_player_snapshot",
+                telegram_id,
+                self.accrual_interval(),
+            )
+            return PlayerSnapshot(
+                currency=row["currency"],
+                income=row["income"],
+                level=row["lvl"],
+                xp=row["xp"],
+                xp_needed=Settings.required_xp_formula(row["lvl"]),
+                prestige=row["prestige"],
+                active_task_id=row["active_task_id"],
+                buildings=dict(zip(row["building_ids"], row["building_counts"])),
             )
 
     @Logger.log_exception
@@ -186,55 +269,61 @@ class UserDAO:
         :return: The user's prestige
         """
         async with self.connection_manager as conn:
-            return await conn.fetchval(
-                "SELECT prestige FROM users WHERE telegram_id = $1", telegram_id
-            )
-
-    async def get_xp(self, telegram_id: int, xp_amount: int) -> int | None:
-        async with self.connection_manager as conn:
-            cur_xp = await conn.fetchval(
-                "SELECT xp FROM users WHERE telegram_id = $1", telegram_id
-            )
-            cur_lvl = await conn.fetchval(
-                "SELECT lvl FROM users WHERE telegram_id = $1", telegram_id
-            )
-            needed_xp = Settings.required_xp_formula(cur_lvl)
-            if cur_xp + xp_amount >= needed_xp:
-                new_amount = cur_xp + xp_amount - needed_xp
-                await conn.execute(
-                    "UPDATE users SET xp = $2 WHERE telegram_id = $1",
-                    telegram_id,
-                    new_amount,
-                )
-
-                await self.level_up(telegram_id)
-
-                recursive_level = await self.get_xp(telegram_id, 0)
-
-                return recursive_level or cur_lvl + 1
-            else:
-                await conn.execute(
-                    "UPDATE users SET xp = xp + $2 WHERE telegram_id = $1",
-                    telegram_id,
-                    xp_amount,
-                )
-                return None
+            return await conn.named_fetchval("users.get_prestige", telegram_id)
 
     @Logger.log_exception
-    async def level_up(self, telegram_id):
+    async def get_xp(self, telegram_id: int, xp_amount: int) -> list[int]:
         """
-        Increases user's level by 1 and gives reward for leveling.
+        Gives experience to the user, applying every level crossed and the sum of their rewards at once.
+        :returns: every level reached, empty if the level didn't change
         """
-        async with self.connection_manager as conn:
-            await conn.execute(
-                "UPDATE users SET lvl = lvl + 1 WHERE telegram_id = $1",
+        async with self.connection_manager as conn, conn.transaction():
+            row = await conn.named_fetchrow(
+                "users.add_xp",
                 telegram_id,
+                xp_amount,
             )
-            self.logger.debug(f"User {telegram_id} leveled up")
-            level = await self.get_level(telegram_id)
-            level = level[0]
-            reward = REWARD_DICT.get(level)
-            self.logger.debug(f"User {telegram_id} got reward {reward.to_user()}")
-            if reward:
-                self.logger.debug(f"Executing reward {telegram_id}, {reward.to_sql()}")
-                await conn.execute(reward.to_sql(), telegram_id)
+            levels = await self.apply_levels(conn, [row])
+            return levels[telegram_id]
+
+    async def apply_levels(self, conn, rows) -> dict[int, list[int]]:
+        """
+        Levels up users by their accumulated experience with a single statement.\n
+        Rows must provide telegram_id, lvl and xp already stored with the gained experience,
+        and be locked by the calling transaction. Users who didn't level up are left untouched.
+        :returns: levels reached by every user
+        """
+        reached: dict[int, list[int]] = {}
+        leveled: list[tuple[int, int, int, int]] = []
+        for row in rows:
+            lvl, xp, levels = apply_xp(row["lvl"], 0, row["xp"])
+            reached[row["telegram_id"]] = levels
+            if not levels:
+                continue
+            currency = 0
+            for level in levels:
+                reward = REWARD_DICT.get(level)
+                if not reward:
+                    continue
+                self.logger.debug(
+                    f"User {row['telegram_id']} got reward {reward.to_user()}"
+                )
+                if reward.to_currency() is not None:
+                    currency += reward.to_currency()
+                else:
+                    await conn.execute(reward.to_sql(), row["telegram_id"])
+            leveled.append((row["telegram_id"], lvl, xp, currency))
+        if not leveled:
+            return reached
+        rows = await conn.named_fetch(
+            "users.apply_levels",
+            *(list(column) for column in zip(*leveled)),
+        )
+        leaderboard.update_many(
+            {
+                row["telegram_id"]: {"currency": row["currency"], "lvl": row["lvl"]}
+                for row in rows
+            }
+        )
+        self.logger.debug(f"Applied levels {reached}")
+        return reached
@@ -0,0 +1,239 @@
+"""
+Webhook update ingress
+
+Usage:
+    python webhook.py
+
+Bot replicas are started by main.py with TELEGRAMBOT_UPDATE_MODE=webhook, each serving
+the webhook endpoint on its own. To run several replicas, this module is started as the
+public endpoint instead: it forwards every update to one of TELEGRAMBOT_WEBHOOK_REPLICAS,
+chosen by rendezvous hashing of the chat id, so updates of one chat always reach the same replica
+and arrive there in order. Changing the replica list only moves the chats of the added or removed replica.
+"""
+
+import asyncio
+import hashlib
+import hmac
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.types import Update
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+from logger import Logger
+from settings import Settings
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = Logger("Webhook").get_logger()
+
+
+def chat_key(update: dict[str, Any]) -> int:
+    """
+    Returns the id of the chat the raw update belongs to (the user id for chatless updates, 0 if unknown)
+    """
+    for field, event in update.items():
+        if field == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        user = event.get("from") or event.get("user")
+        if chat:
+            return chat["id"]
+        if user:
+            return user["id"]
+    return 0
+
+
+def user_key(update: dict[str, Any]) -> int:
+    """
+    Returns the id of the user who sent the raw update (the chat id for updates without one, 0 if unknown)
+    """
+    for field, event in update.items():
+        if field == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return chat_key(update)
+
+
+def rendezvous(key: int, nodes: list[str]) -> list[str]:
+    """
+    Orders nodes by their highest random weight for the key, the first one owns the key
+    """
+    return sorted(
+        nodes,
+        key=lambda node: hashlib.blake2b(
+            f"{node}:{key}".encode(), digest_size=8
+        ).digest(),
+        reverse=True,
+    )
+
+
+class ChatSequencer:
+    """
+    Runs jobs of the same chat one after another and jobs of different chats concurrently
+    """
+
+    def __init__(self) -> None:
+        self.tails: dict[int, asyncio.Task] = {}
+
+    def submit(self, key: int, job: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        previous = self.tails.get(key)
+        task = asyncio.create_task(self.run(key, previous, job))
+        self.tails[key] = task
+        return task
+
+    async def run(
+        self,
+        key: int,
+        previous: asyncio.Task | None,
+        job: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        try:
+            if previous:
+                await asyncio.wait([previous])
+            return await job()
+        finally:
+            if self.tails.get(key) is asyncio.current_task():
+                del self.tails[key]
+
+
+async def feed_update(dp: Dispatcher, bot: Bot, data: dict[str, Any]) -> None:
+    """
+    Handles a raw update with the dispatcher, logging failures
+    """
+    try:
+        update = Update.model_validate(data, context={"bot": bot})
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception(f"Failed to handle update {data.get('update_id')}")
+
+
+def check_secret(request: web.Request) -> bool:
+    if not Settings.webhook_secret:
+        return True
+    return hmac.compare_digest(
+        request.headers.get(SECRET_HEADER, ""), Settings.webhook_secret
+    )
+
+
+async def set_webhook(bot: Bot) -> None:
+    """
+    Registers the public webhook url, if configured
+    """
+    if not Settings.webhook_url:
+        return
+    await bot.set_webhook(
+        Settings.webhook_url.rstrip("/") + Settings.webhook_path,
+        secret_token=Settings.webhook_secret or None,
+        max_connections=Settings.webhook_max_connections,
+    )
+
+
+async def serve(app: web.Application) -> None:
+    """
+    Serves the application on the configured address until cancelled
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, Settings.webhook_host, Settings.webhook_port)
+    await site.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def replica_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """
+    Application feeding webhook updates into the dispatcher.\n
+    Telegram gets its response as soon as the update is queued, updates of one chat are handled in order.
+    """
+    sequencer = ChatSequencer()
+
+    async def handle(request: web.Request) -> web.Response:
+        if not check_secret(request):
+            return web.Response(status=401)
+        data = await request.json()
+        sequencer.submit(chat_key(data), lambda: feed_update(dp, bot, data))
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(Settings.webhook_path, handle)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """
+    Serves updates of a single replica
+    """
+    await set_webhook(bot)
+    await serve(replica_app(dp, bot))
+
+
+def ingress_app(replicas: list[str]) -> web.Application:
+    """
+    Application forwarding webhook updates to the replica owning the chat.\n
+    Falls back to the next replica by weight if the owner is unavailable.
+    """
+    sequencer = ChatSequencer()
+    headers = (
+        {SECRET_HEADER: Settings.webhook_secret} if Settings.webhook_secret else {}
+    )
+
+    async def forward(session: ClientSession, key: int, body: bytes) -> bool:
+        for replica in rendezvous(key, replicas):
+            try:
+                async with session.post(
+                    replica.rstrip("/") + Settings.webhook_path,
+                    data=body,
+                    headers={"Content-Type": "application/json", **headers},
+                ) as response:
+                    if response.status < 500:
+                        return True
+                    logger.warning(f"Replica {replica} responded {response.status}")
+            except (asyncio.TimeoutError, ClientError) as e:
+                logger.warning(f"Replica {replica} is unavailable: {e}")
+        return False
+
+    async def handle(request: web.Request) -> web.Response:
+        if not check_secret(request):
+            return web.Response(status=401)
+        body = await request.read()
+        key = chat_key(await request.json())
+        session = request.app["session"]
+        if await sequencer.submit(key, lambda: forward(session, key, body)):
+            return web.Response()
+        # Telegram will deliver the update again later
+        return web.Response(status=503)
+
+    async def session_context(app: web.Application):
+        app["session"] = ClientSession(timeout=ClientTimeout(total=10))
+        yield
+        await app["session"].close()
+
+    app = web.Application()
+    app.cleanup_ctx.append(session_context)
+    app.router.add_post(Settings.webhook_path, handle)
+    return app
+
+
+async def main():
+    if not Settings.webhook_replicas:
+        logger.fatal("TELEGRAMBOT_WEBHOOK_REPLICAS is not set; Shutting down.")
+        return
+    bot = Bot(token=Settings.token, default=DefaultBotProperties())
+    try:
+        await set_webhook(bot)
+    finally:
+        await bot.session.close()
+    logger.info(f"Forwarding updates to {', '.join(Settings.webhook_replicas)}")
+    await serve(ingress_app(Settings.webhook_replicas))
+
+
+if __name__ == "__main__":
+    logger.info("Starting ingress")
+    asyncio.run(main())
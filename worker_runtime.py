@@ -0,0 +1,122 @@
+"""
+Module providing the long-lived asyncio runtime of a celery worker process
+"""
+
+import asyncio
+import threading
+from collections.abc import Coroutine
+from typing import Any, Optional
+
+from database import ConnectionManager
+from logger import Logger
+from settings import Settings
+from tasks.schema import CompletedTask
+from tasks.tasks_repo import UserTaskDAO
+
+
+class WorkerRuntime:
+    """
+    Runs one event loop per worker process in a background thread, so the database pool and DAOs
+    live as long as the process does.\n
+    Task completions submitted within Settings.worker_batch_window seconds of each other
+    are coalesced and completed in one database transaction. Every pool thread blocks on its own completion,
+    so a batch is flushed at once when it holds Settings.worker_batch_size completions (at most one per thread).
+    """
+
+    _instance: Optional["WorkerRuntime"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self) -> None:
+        self.logger = Logger(__class__.__name__).get_logger()  # type: ignore[name-defined]
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="worker-runtime", daemon=True
+        )
+        self.thread.start()
+        self.user_task_dao = UserTaskDAO()
+        self.pending: list[tuple[tuple[int, int], asyncio.Future]] = []
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.logger.info("Worker runtime started")
+
+    @classmethod
+    def get(cls) -> "WorkerRuntime":
+        """
+        Returns the runtime of the current process, starting it on first use
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """
+        Stops the runtime of the current process if it was started
+        """
+        with cls._instance_lock:
+            if cls._instance is not None:
+                cls._instance.close()
+                cls._instance = None
+
+    def run(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        """
+        Runs a coroutine on the runtime loop and blocks until it's done
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def complete_task(self, telegram_id: int, task_id: int) -> list[int]:
+        """
+        Completes the user task, possibly together with other pending completions
+        :returns: levels reached by the user
+        """
+        return self.run(self._complete_task(telegram_id, task_id))
+
+    async def _complete_task(self, telegram_id: int, task_id: int) -> list[int]:
+        future = self.loop.create_future()
+        self.pending.append(((telegram_id, task_id), future))
+        if len(self.pending) >= Settings.worker_batch_size:
+            await self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(
+                Settings.worker_batch_window, self._schedule_flush
+            )
+        return await future
+
+    def _schedule_flush(self) -> None:
+        self.flush_handle = None
+        self.loop.create_task(self.flush())
+
+    async def flush(self) -> None:
+        """
+        Completes all pending completions in one transaction
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            completed: list[CompletedTask] = await self.user_task_dao.complete_tasks(
+                [completion for completion, _ in batch]
+            )
+        # Passed on to every task waiting for the batch
+        except Exception as e:  # noqa: BLE001
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        levels = {(task.telegram_id, task.task_id): task.levels for task in completed}
+        self.logger.info(f"Completed {len(completed)}/{len(batch)} tasks in one batch")
+        for completion, future in batch:
+            future.set_result(levels.get(completion, []))
+
+    def close(self) -> None:
+        """
+        Flushes pending completions, closes the database pool and stops the loop
+        """
+        self.run(self.flush())
+        self.run(ConnectionManager.close_pool())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.logger.info("Worker runtime stopped")